@@ -0,0 +1,319 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+# 压测时放宽发送频率限制，避免测到的只是 429；总是放在 --server-args 之前，需要时可被其覆盖
+BASE_SERVER_ARGS = ['--max-messages-per-minute', '1000000000']
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+class Scenario:
+    """一类模拟客户端：记录每个请求的延迟、状态码与收到的字节数。"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes_received = 0
+
+    def record(self, latency, status, size):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes_received += size
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def report(self, duration):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'throughput': len(latencies) / duration if duration else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+            'bytes_received': self.bytes_received,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+        }
+
+
+def percentile(values, percent):
+    # values 需已排序
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Client:
+    """一个使用持久连接的模拟客户端，连接断开时自动重连。"""
+    def __init__(self, port, timeout=30):
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body, headers or {})
+                response = self.connection.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+                    self.close()
+                return response.status, data, response
+            except (ConnectionError, http.client.HTTPException, socket.timeout):
+                self.close()
+                # 服务器可能已关闭空闲的持久连接，重试一次
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def random_text(size):
+    # 消息中不能包含服务器拒绝的非法字符
+    return ''.join(random.choices(string.ascii_letters + string.digits + ' ', k=size))
+
+
+def poller(port, rooms, scenario, stop, interval, conditional):
+    client = Client(port)
+    etags = {}
+    while not stop.is_set():
+        roomid = random.choice(rooms)
+        headers = {'Accept-Encoding': 'gzip', 'Accept-Language': 'zh-CN,zh;q=0.9'}
+        if conditional and roomid in etags:
+            headers['If-None-Match'] = etags[roomid]
+        started = time.perf_counter()
+        try:
+            status, data, response = client.request('GET', f'/log?id={quote(roomid)}&lang=zh', headers=headers)
+        except Exception:
+            scenario.record_error()
+            continue
+        scenario.record(time.perf_counter() - started, status, len(data))
+        if response.getheader('ETag'):
+            etags[roomid] = response.getheader('ETag')
+        if interval:
+            stop.wait(interval)
+    client.close()
+
+
+def sender(port, rooms, scenario, stop, interval, message_size):
+    client = Client(port)
+    nickname = f'bench{threading.get_ident() % 10000}'
+    while not stop.is_set():
+        roomid = random.choice(rooms)
+        body = urlencode({'nickname': nickname, 'roomid': roomid, 'messageInput': random_text(message_size), 'lang': 'zh'})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        started = time.perf_counter()
+        try:
+            status, data, _ = client.request('POST', '/send_message', body, headers)
+        except Exception:
+            scenario.record_error()
+            continue
+        scenario.record(time.perf_counter() - started, status, len(data))
+        if interval:
+            stop.wait(interval)
+    client.close()
+
+
+def page_loader(port, rooms, scenario, stop, interval):
+    client = Client(port)
+    while not stop.is_set():
+        roomid = random.choice(rooms)
+        headers = {'Accept-Encoding': 'gzip, br', 'Accept-Language': 'en-US,en;q=0.5'}
+        started = time.perf_counter()
+        try:
+            # 与浏览器打开聊天室一样，依次请求主页、聊天页与静态资源
+            for path in ('/', f'/chat?nickname=bench&roomid={quote(roomid)}', '/lb-chat.css', '/main.js'):
+                status, data, _ = client.request('GET', path, headers=headers)
+                if status != 200:
+                    break
+        except Exception:
+            scenario.record_error()
+            continue
+        scenario.record(time.perf_counter() - started, status, len(data))
+        if interval:
+            stop.wait(interval)
+    client.close()
+
+
+def read_proc_status(pid):
+    """读取进程的常驻内存（KiB）与写入磁盘的字节数，不支持的平台返回 None。"""
+    rss = written = None
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        with open(f'/proc/{pid}/io') as io_file:
+            for line in io_file:
+                if line.startswith('write_bytes:'):
+                    written = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, written
+
+
+def data_files_size(directory):
+    sizes = {}
+    for name in os.listdir(directory):
+        if name.startswith('chat_records'):
+            sizes[name] = os.path.getsize(os.path.join(directory, name))
+    return sizes
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start in time')
+
+
+def run(args):
+    port = args.port or free_port()
+    rooms = [f'room{index}' for index in range(args.rooms)]
+    with tempfile.TemporaryDirectory(prefix='lb-chat-bench-') as directory:
+        command = [sys.executable, SERVER_SCRIPT, '--port', str(port)] + BASE_SERVER_ARGS + shlex.split(args.server_args)
+        process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(port, process)
+
+            # 预热：每个房间先发若干消息，使聊天记录接近稳定大小
+            client = Client(port)
+            for roomid in rooms:
+                for _ in range(args.warmup_messages):
+                    body = urlencode({'nickname': 'warmup', 'roomid': roomid, 'messageInput': random_text(args.message_size)})
+                    client.request('POST', '/send_message', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            client.close()
+
+            rss_before, written_before = read_proc_status(process.pid)
+            scenarios = {name: Scenario(name) for name in ('poll_log', 'send_message', 'page_load')}
+            stop = threading.Event()
+            threads = []
+            for _ in range(args.pollers):
+                threads.append(threading.Thread(target=poller, args=(port, rooms, scenarios['poll_log'], stop, args.poll_interval, args.conditional)))
+            for _ in range(args.senders):
+                threads.append(threading.Thread(target=sender, args=(port, rooms, scenarios['send_message'], stop, args.send_interval, args.message_size)))
+            for _ in range(args.page_loaders):
+                threads.append(threading.Thread(target=page_loader, args=(port, rooms, scenarios['page_load'], stop, args.page_interval)))
+
+            started = time.perf_counter()
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            stop.wait(args.duration)
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=35)
+            duration = time.perf_counter() - started
+            rss_after, written_after = read_proc_status(process.pid)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        files = data_files_size(directory)
+
+    return {
+        'config': {
+            'pollers': args.pollers, 'senders': args.senders, 'page_loaders': args.page_loaders,
+            'rooms': args.rooms, 'message_size': args.message_size, 'duration': args.duration,
+            'poll_interval': args.poll_interval, 'send_interval': args.send_interval, 'page_interval': args.page_interval,
+            'conditional': args.conditional, 'server_args': args.server_args,
+        },
+        'scenarios': {name: scenario.report(duration) for name, scenario in scenarios.items() if scenario.latencies or scenario.errors},
+        'memory_kib': {'before': rss_before, 'after': rss_after, 'growth': rss_after - rss_before if rss_before and rss_after else None},
+        'disk_bytes_written': written_after - written_before if written_before is not None and written_after is not None else None,
+        'data_files': files,
+    }
+
+
+def print_report(result, baseline=None):
+    print(f"{'scenario':<14}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}  statuses")
+    for name, report in result['scenarios'].items():
+        print(f"{name:<14}{report['throughput']:>10.1f}{report['p50_ms']:>10.2f}{report['p95_ms']:>10.2f}{report['p99_ms']:>10.2f}{report['errors']:>8}  {report['statuses']}")
+        if baseline and name in baseline['scenarios']:
+            old = baseline['scenarios'][name]
+            print(f"{'  vs baseline':<14}{change(old['throughput'], report['throughput']):>10}{change(old['p50_ms'], report['p50_ms']):>10}{change(old['p95_ms'], report['p95_ms']):>10}{change(old['p99_ms'], report['p99_ms']):>10}")
+    memory = result['memory_kib']
+    print(f"memory: {memory['before']} KiB -> {memory['after']} KiB (growth {memory['growth']} KiB)")
+    print(f"disk bytes written during load: {result['disk_bytes_written']}")
+    print(f"data files after shutdown: {result['data_files']}")
+
+
+def change(old, new):
+    if not old:
+        return '-'
+    return f'{(new - old) / old * 100:+.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天室压测：启动 server.py 并模拟轮询、发送与页面访问')
+    parser.add_argument('--port', type=int, default=0, help='Port for the server under test (default: a free port).')
+    parser.add_argument('--server-args', default='', help='Extra arguments passed to server.py after the rate limit override.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the load.')
+    parser.add_argument('--pollers', type=int, default=20, help='Concurrent /log pollers.')
+    parser.add_argument('--senders', type=int, default=2, help='Concurrent /send_message senders.')
+    parser.add_argument('--page-loaders', type=int, default=2, help='Concurrent page loaders of /, /chat and static assets.')
+    parser.add_argument('--rooms', type=int, default=8, help='Number of rooms to spread the load over.')
+    parser.add_argument('--message-size', type=int, default=64, help='Characters per sent message.')
+    parser.add_argument('--warmup-messages', type=int, default=20, help='Messages sent to each room before measuring.')
+    parser.add_argument('--poll-interval', type=float, default=0, help='Seconds each poller waits between requests (0: as fast as possible).')
+    parser.add_argument('--send-interval', type=float, default=0.1, help='Seconds each sender waits between messages.')
+    parser.add_argument('--page-interval', type=float, default=0, help='Seconds each page loader waits between page views.')
+    parser.add_argument('--conditional', action='store_true', help='Pollers send If-None-Match like a caching browser.')
+    parser.add_argument('--save', metavar='FILE', help='Save results as JSON, e.g. as a baseline.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare results with a saved baseline.')
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(result, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as result_file:
+            json.dump(result, result_file, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
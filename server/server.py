@@ -2,60 +2,1646 @@ import threading
 import http.server
 import socketserver
 import configparser
+import bisect
+import contextlib
+import functools
+import gzip
+import hashlib
+import html
+import json
+import string
+from collections import OrderedDict, deque
+from itertools import groupby, islice
+from concurrent.futures import ThreadPoolExecutor
 import os
 import time
 from urllib.parse import urlparse, parse_qs, quote
+from email.utils import formatdate, parsedate_to_datetime
 import argparse
 import logging
+import logging.handlers
+import math
+import mmap
+import queue
+import random
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 class ChatConfig:
-    def __init__(self):
+    def __init__(self, config_file='chat_records.ini'):
         self.config = configparser.ConfigParser()
-        self.config_file = 'chat_records.ini'
+        self.config_file = config_file
         if not os.path.exists(self.config_file):
             open(self.config_file, 'w', encoding='utf-8').close()
         with open(self.config_file, 'r', encoding='utf-8') as config_file:
             self.config.read_file(config_file)
 
-class ChatServer(http.server.BaseHTTPRequestHandler):
-    rooms = {}
+class PageTemplate:
+    """预编译的页面模板。
+
+    静态部分在启动时编码为字节，渲染时只拼接转义好的动态字段。
+    """
+    __slots__ = ('parts',)
+
+    def __init__(self, text):
+        self.parts = []
+        for literal, field, _, _ in string.Formatter().parse(text):
+            if literal:
+                self.parts.append(literal.encode('utf-8'))
+            if field is not None:
+                self.parts.append(field)
+
+    def render(self, **values):
+        return b''.join(part if isinstance(part, bytes) else values[part].encode('utf-8') for part in self.parts)
+
+class StaticAsset:
+    """启动时构建的静态资源：内容哈希 ETag 以及 gzip/brotli 压缩版本。"""
+    __slots__ = ('body', 'content_type', 'etag', 'variants')
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.variants = {}
+        if brotli is not None:
+            self.add_variant('br', brotli.compress(body))
+        self.add_variant('gzip', gzip.compress(body, 9, mtime=0))
+
+    def add_variant(self, encoding, body):
+        # 压缩后反而更大的资源（如很小的图标）不提供压缩版本
+        if len(body) < len(self.body):
+            self.variants[encoding] = body
+
+class Message:
+    """一条聊天消息：发送时间（epoch 秒）、昵称与内容，显示时才格式化。"""
+    __slots__ = ('time', 'nickname', 'text')
+
+    def __init__(self, timestamp, nickname, text):
+        self.time = timestamp
+        self.nickname = nickname
+        self.text = text
+
+    def format(self):
+        if not self.time:
+            return self.text
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time))
+        return f'{timestamp} {self.nickname}: {self.text}'
+
+    @classmethod
+    def parse(cls, line):
+        """解析旧格式的 “时间 昵称: 消息” 文本。"""
+        nickname, separator, text = line[20:].partition(': ')
+        try:
+            timestamp = time.mktime(time.strptime(line[:19], '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            timestamp = None
+        if timestamp is None or not separator:
+            # 无法解析的记录保留原文，以昵称为空显示
+            return cls(0, '', line)
+        return cls(timestamp, sys.intern(nickname), text)
+
+class Room:
+    """单个聊天室：固定容量的消息环形缓冲、最后一条消息的序号与最后修改时间。
+
+    序号单调递增，messages 中最后一条消息的序号为 seq。
+    """
+    __slots__ = ('messages', 'seq', 'modified')
+
+    def __init__(self, capacity, messages=(), seq=None, modified=None):
+        self.messages = deque(messages, maxlen=capacity)
+        self.seq = seq if seq is not None else len(self.messages)
+        self.modified = modified if modified is not None else time.time()
+
+    def messages_since(self, since):
+        count = self.seq - since
+        # 游标无效（例如房间被重建）时返回全部消息
+        if since <= 0 or count < 0 or count >= len(self.messages):
+            return list(self.messages)
+        # 从尾部取，代价只与新消息数量有关
+        return list(islice(reversed(self.messages), count))[::-1]
+
+class ChatStore:
+    """进程内唯一的聊天室存储，由所有请求处理器共享。
+
+    启动时加载一次聊天记录，由单个后台线程定时保存，关闭时再保存一次。
+    默认以 INI 格式保存到 config_file。rooms 按最后活动时间排序，
+    房间数超过上限时淘汰最久没有新消息的房间。
+    """
     max_rooms = 32
     max_messages_per_room = 50
+
+    def __init__(self, config_file='chat_records.ini', flush_interval=120):
+        self.config_file = config_file
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        # 串行化文件写入，避免多个保存同时写同一个临时文件
+        self.save_lock = threading.Lock()
+        self.rooms = OrderedDict()
+        # 正在长轮询等待的房间：roomid -> [Condition, 等待者数量]
+        self.waiters = {}
+        # 房间内容变化（新消息或被淘汰）时调用的回调，参数为 roomid
+        self.listeners = []
+        self.dirty = False
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        # 由 create_store() 在启用归档时设置，移出内存的消息写入 HistoryArchive
+        self.archive = None
+        # 统计：保存次数、保存耗时、写入字节数与淘汰的房间数
+        self.saves = 0
+        self.save_seconds = 0.0
+        self.bytes_written = 0
+        self.evictions = 0
+
+    def load(self):
+        self.import_ini(self.config_file)
+
+    def save(self):
+        with self.save_lock:
+            self.dirty = False
+            rooms = self.iter_rooms()
+            # 替换后的文件不含已移出内存的消息，先把它们写入归档并落盘
+            if self.archive is not None:
+                self.archive.flush()
+            self.export_ini(self.config_file, rooms)
+
+    def import_ini(self, path):
+        config = ChatConfig(path).config
+        with self.lock:
+            for section in config.sections():
+                lines = config.get(section, 'messages').split('\n')
+                self.put_room(section, [Message.parse(line) for line in lines if line])
+            self.trim_rooms()
+            self.dirty = True
+
+    def put_room(self, roomid, messages):
+        if self.archive is None:
+            self.rooms[roomid] = Room(self.max_messages_per_room, messages)
+            return
+        # 导入的记录替换现有房间时，先归档原有消息，序号接着归档继续
+        if roomid in self.rooms:
+            self.archive_room(roomid, self.rooms[roomid])
+        self.rooms[roomid] = Room(self.max_messages_per_room, messages, self.archive.last_seq(roomid) + len(messages))
+
+    def iter_rooms(self):
+        """按最后活动时间从旧到新返回 (roomid, messages)。"""
+        with self.lock:
+            return [(roomid, list(room.messages)) for roomid, room in self.rooms.items()]
+
+    def export_ini(self, path, rooms=None):
+        config = configparser.ConfigParser()
+        for roomid, messages in self.iter_rooms() if rooms is None else rooms:
+            config[roomid] = {'messages': '\n'.join(message.format() for message in messages)}
+        # 先写临时文件再替换，避免保存中途崩溃损坏记录
+        temp_file = path + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as configfile:
+            config.write(configfile)
+        self.bytes_written += os.path.getsize(temp_file)
+        os.replace(temp_file, path)
+
+    def flush(self):
+        if self.dirty:
+            started = time.perf_counter()
+            self.save()
+            self.saves += 1
+            self.save_seconds += time.perf_counter() - started
+
+    def start(self):
+        # 只启动一个后台线程，每 flush_interval 秒保存一次聊天数据
+        self.flush_thread = threading.Thread(target=self.flush_periodically, name='chat-flusher', daemon=True)
+        self.flush_thread.start()
+        if self.archive is not None:
+            self.archive.start()
+
+    def flush_periodically(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error saving chat records: {e}")
+
+    def close(self):
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+        self.flush()
+        if self.archive is not None:
+            self.archive.close()
+
+    def add_message(self, roomid, nickname, message):
+        message = Message(time.time(), sys.intern(nickname), message)
+        with self.lock:
+            self.apply_message(roomid, message)
+            self.dirty = True
+            ticket = self.log_message(roomid, message)
+        # 在锁外等待持久化完成，让并发发送者可以共享一次写盘
+        self.commit(ticket)
+
+    def apply_message(self, roomid, message):
+        room = self.rooms.get(roomid)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms:
+                # 淘汰最久没有新消息的房间
+                oldest_room, evicted = self.rooms.popitem(last=False)
+                self.evictions += 1
+                self.archive_room(oldest_room, evicted)
+                self.notify(oldest_room)
+            # 序号接着已归档的消息继续，避免与归档重复
+            room = self.rooms[roomid] = Room(self.max_messages_per_room, seq=self.archive.last_seq(roomid) if self.archive else None)
+        else:
+            self.rooms.move_to_end(roomid)
+        if self.archive is not None and len(room.messages) == room.messages.maxlen:
+            self.archive.append(roomid, [(room.seq - len(room.messages) + 1, room.messages[0])])
+        # 环形缓冲满时自动丢弃最旧的消息
+        room.messages.append(message)
+        room.seq += 1
+        room.modified = message.time
+        self.notify(roomid)
+
+    def trim_rooms(self):
+        # 加载的记录可能来自房间上限更大的配置
+        while len(self.rooms) > self.max_rooms:
+            oldest_room, evicted = self.rooms.popitem(last=False)
+            self.evictions += 1
+            self.archive_room(oldest_room, evicted)
+            self.notify(oldest_room)
+
+    def archive_room(self, roomid, room):
+        if self.archive is not None:
+            first_seq = room.seq - len(room.messages) + 1
+            self.archive.append(roomid, zip(range(first_seq, room.seq + 1), room.messages))
+
+    def notify(self, roomid):
+        # 调用者需持有 self.lock
+        if roomid in self.waiters:
+            self.waiters[roomid][0].notify_all()
+        for listener in self.listeners:
+            listener(roomid)
+
+    def log_message(self, roomid, message):
+        # INI 存储只依赖定时保存，无需逐条记录
+        return None
+
+    def commit(self, ticket):
+        pass
+
+    def get_messages(self, roomid, since=0):
+        """返回 (seq, modified, messages)，messages 为序号大于 since 的消息。"""
+        with self.lock:
+            room = self.rooms.get(roomid)
+            if room is None:
+                return 0, None, []
+            return room.seq, room.modified, room.messages_since(since)
+
+    def get_seq(self, roomid):
+        room = self.rooms.get(roomid)
+        return room.seq if room is not None else None
+
+    def get_unarchived(self, roomid):
+        """按序号升序返回尚未确认写入归档的 (seq, message)：归档队列中的与内存中的消息。"""
+        with self.lock:
+            entries = self.archive.unarchived(roomid) if self.archive is not None else []
+            room = self.rooms.get(roomid)
+            if room is not None:
+                entries += zip(range(room.seq - len(room.messages) + 1, room.seq + 1), room.messages)
+            return entries
+
+    def get_history(self, roomid, before, limit):
+        """返回序号小于 before（不大于 0 时为最新）的最后 limit 条消息，
+        为按序号升序的 JSON 字节串，先取尚未归档的消息，不足时再读归档。"""
+        if before <= 0:
+            before = sys.maxsize
+        entries = self.get_unarchived(roomid)
+        lines = [HistoryArchive.encode(seq, message) for seq, message in [entry for entry in entries if entry[0] < before][-limit:]]
+        if len(lines) < limit and self.archive is not None:
+            # 归档中序号不小于首条未归档消息的记录与上面重复
+            lines[:0] = self.archive.read(roomid, min(before, entries[0][0]) if entries else before, limit - len(lines))
+        return lines
+
+    def stats(self):
+        with self.lock:
+            rooms = len(self.rooms)
+            messages = sum(len(room.messages) for room in self.rooms.values())
+        return {'rooms': rooms, 'messages': messages, 'evictions': self.evictions, 'saves': self.saves, 'save_seconds': self.save_seconds, 'bytes_written': self.bytes_written}
+
+    def wait_for_messages(self, roomid, since, timeout):
+        """阻塞直到房间出现序号大于 since 的消息或超时。"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            waiter = self.waiters.setdefault(roomid, [threading.Condition(self.lock), 0])
+            waiter[1] += 1
+            try:
+                while True:
+                    seq = self.get_seq(roomid)
+                    if seq is not None and seq != since:
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self.stop_event.is_set():
+                        return
+                    waiter[0].wait(remaining)
+            finally:
+                waiter[1] -= 1
+                if not waiter[1]:
+                    del self.waiters[roomid]
+
+class CachedLog:
+    __slots__ = ('key', 'version', 'body', 'gzip_body')
+
+    def __init__(self, key, version, body):
+        self.key = key
+        self.version = version
+        self.body = body
+        self.gzip_body = None
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzip_body or b'')
+
+class LogCache:
+    """按 (房间号, 语言) 缓存渲染好的聊天记录页面及其 gzip 版本。
+
+    房间有新消息或被淘汰时失效，总大小超过 max_bytes 时按最近最少使用淘汰。
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, roomid, lang, version):
+        key = (roomid, lang)
+        with self.lock:
+            entry = self.entries.get(key)
+            # 版本（序号与修改时间）不一致说明渲染后又有新消息，视为未命中
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, roomid, lang, version, body):
+        entry = CachedLog((roomid, lang), version, body)
+        with self.lock:
+            self.remove(entry.key)
+            self.entries[entry.key] = entry
+            self.size += entry.size
+            self.shrink()
+        return entry
+
+    def get_gzip(self, entry):
+        if entry.gzip_body is None:
+            gzip_body = gzip.compress(entry.body, mtime=0)
+            with self.lock:
+                if entry.gzip_body is None:
+                    entry.gzip_body = gzip_body
+                    # 条目可能已被淘汰，只有仍在缓存中时才计入大小
+                    if self.entries.get(entry.key) is entry:
+                        self.size += len(gzip_body)
+                        self.shrink()
+        return entry.gzip_body
+
+    def invalidate(self, roomid):
+        with self.lock:
+            for lang in ('zh', 'en'):
+                self.remove((roomid, lang))
+
+    def remove(self, key):
+        # 调用者需持有 self.lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def shrink(self):
+        # 调用者需持有 self.lock
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class Journal:
+    """追加写的消息日志，每行一条 JSON 记录。
+
+    并发写入者先把记录放入队列，再由其中一个线程把整批记录一次写入并 fsync（组提交）。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.cond = threading.Condition()
+        self.pending = []
+        self.queued = 0
+        self.synced = 0
+        self.syncing = False
+        self.bytes_written = 0
+
+    def enqueue(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.cond:
+            self.pending.append(line)
+            self.queued += 1
+            return self.queued
+
+    def wait(self, ticket):
+        with self.cond:
+            while self.synced < ticket:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                # 没有进行中的提交，由本线程负责写入当前所有待写记录
+                batch, self.pending = self.pending, []
+                batch_end = self.queued
+                self.syncing = True
+                self.cond.release()
+                try:
+                    self.write(batch)
+                except BaseException:
+                    self.cond.acquire()
+                    # 放回队列，由下一个提交者重试
+                    self.pending[:0] = batch
+                    self.syncing = False
+                    self.cond.notify_all()
+                    raise
+                self.cond.acquire()
+                self.synced = batch_end
+                self.syncing = False
+                self.cond.notify_all()
+
+    def write(self, batch):
+        if batch:
+            data = b''.join(batch)
+            self.file.write(data)
+            self.bytes_written += len(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def drain(self):
+        # 调用者需持有 self.cond
+        while self.syncing:
+            self.cond.wait()
+        self.write(self.pending)
+        self.pending = []
+        self.synced = self.queued
+        self.cond.notify_all()
+
+    def rotate(self, old_path):
+        with self.cond:
+            self.drain()
+            self.file.close()
+            os.replace(self.path, old_path)
+            self.file = open(self.path, 'ab')
+
+    def close(self):
+        with self.cond:
+            self.drain()
+            self.file.close()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能只写了一半，未确认的记录直接丢弃
+                    logging.warning(f"Skipping damaged journal record in {path}")
+
+class HistoryArchive:
+    """移出内存窗口的消息归档，按房间分目录保存为分段文件。
+
+    每个分段包含序号连续的消息：NNNN.ndjson 每行一条 JSON 记录，
+    NNNN.idx 依次保存每条记录在数据文件中的偏移（4 字节小端整数），NNNN 为首条消息的序号。
+    读取时对两个文件做内存映射，只解码所需的记录。数据先于索引写入并 fsync，索引中的记录总是完整的。
+
+    append() 只把消息放入待写队列，由后台线程批量写入并清理，不占用存储锁；
+    存储在删除仍包含这些消息的快照或日志前调用 flush()，确保它们已经落盘。
+    各房间最后一个分段的状态与按写入时间排序的分段大小缓存在内存中，写入与清理都不扫描目录。
+    多个进程共用一个目录时，只有取得目录锁的进程写入。
+    """
+    segment_messages = 1000
+    # 没有新消息时，检查过期分段的间隔（秒）
+    prune_interval = 3600
+    # 写入失败后重试的间隔（秒）
+    retry_interval = 5
+
+    def __init__(self, directory, retention=0, max_bytes=0):
+        self.directory = directory
+        self.retention = retention
+        self.max_bytes = max_bytes
+        # 保护待写队列；write_lock 串行化磁盘写入与缓存的磁盘状态
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()
+        # 串行化 flush()，返回时此前放入队列的消息都已落盘
+        self.flush_lock = threading.Lock()
+        # roomid -> [(seq, message)]：等待写入与正在写入的消息
+        self.pending = {}
+        self.writing = {}
+        # 尚未写入磁盘的各房间最大序号，写入后改由 tails 提供
+        self.last_seqs = {}
+        # 房间目录 -> [最后一个分段的首条序号, 记录数]
+        self.tails = {}
+        # 分段路径 -> [字节数, 最后写入时间]，按最后写入时间排序
+        self.files = OrderedDict()
+        self.total = 0
+        self.lock_file = None
+        self.closed = False
+        self.writer_thread = None
+        self.bytes_written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def encode(seq, message):
+        return json.dumps({'seq': seq, 'time': message.time, 'nickname': message.nickname, 'text': message.text}, ensure_ascii=False).encode('utf-8')
+
+    def room_dir(self, roomid):
+        # 房间号可能很长或含有路径字符，用哈希作为目录名
+        return os.path.join(self.directory, hashlib.sha256(roomid.encode('utf-8')).hexdigest()[:32])
+
+    def segments(self, roomid):
+        """按序号升序返回房间各分段的首条序号。"""
+        try:
+            names = os.listdir(self.room_dir(roomid))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.idx'))
+
+    def segment_path(self, roomid, first_seq):
+        return os.path.join(self.room_dir(roomid), f'{first_seq:016d}')
+
+    def segment_count(self, path):
+        try:
+            return os.path.getsize(path + '.idx') // 4
+        except FileNotFoundError:
+            return 0
+
+    def acquire(self):
+        """取得写入权并加载磁盘状态；目录已被其他进程使用时返回 False。"""
+        if self.lock_file is not None:
+            return True
+        lock_file = open(os.path.join(self.directory, '.lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self.lock_file = lock_file
+        self.scan()
+        return True
+
+    def scan(self):
+        # 只在取得写入权时扫描一次
+        segments = []
+        with self.write_lock:
+            self.tails.clear()
+            for room in os.listdir(self.directory):
+                room_dir = os.path.join(self.directory, room)
+                if not os.path.isdir(room_dir):
+                    continue
+                first_seqs = sorted(int(name[:-4]) for name in os.listdir(room_dir) if name.endswith('.idx'))
+                for first_seq in first_seqs:
+                    path = os.path.join(room_dir, f'{first_seq:016d}')
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = os.stat(path + '.ndjson')
+                        segments.append((stat.st_mtime, path, stat.st_size + self.segment_count(path) * 4))
+                if first_seqs:
+                    self.tails[room_dir] = [first_seqs[-1], self.segment_count(os.path.join(room_dir, f'{first_seqs[-1]:016d}'))]
+            self.files.clear()
+            for modified, path, size in sorted(segments):
+                self.files[path] = [size, modified]
+            self.total = sum(size for _, _, size in segments)
+
+    def last_seq(self, roomid):
+        with self.lock:
+            if roomid in self.last_seqs:
+                return self.last_seqs[roomid]
+        tail = self.tails.get(self.room_dir(roomid))
+        return tail[0] + tail[1] - 1 if tail else 0
+
+    def append(self, roomid, entries):
+        """把按序号升序的 (seq, message) 放入待写队列。"""
+        entries = list(entries)
+        if not entries:
+            return
+        with self.cond:
+            self.pending.setdefault(roomid, []).extend(entries)
+            self.last_seqs[roomid] = max(self.last_seqs.get(roomid, 0), entries[-1][0])
+            self.cond.notify()
+
+    def unarchived(self, roomid):
+        """返回已放入队列但可能尚未写入磁盘的消息。"""
+        with self.lock:
+            return self.writing.get(roomid, []) + self.pending.get(roomid, [])
+
+    def start(self):
+        self.writer_thread = threading.Thread(target=self.write_periodically, name='archive-writer', daemon=True)
+        self.writer_thread.start()
+
+    def write_periodically(self):
+        while True:
+            with self.cond:
+                if not self.pending and not self.closed:
+                    self.cond.wait(self.prune_interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error writing chat archive: {e}")
+                if not closed:
+                    self.stop_wait(self.retry_interval)
+            if closed:
+                return
+
+    def stop_wait(self, timeout):
+        with self.cond:
+            if not self.closed:
+                self.cond.wait(timeout)
+
+    def flush(self):
+        """写入队列中的消息，返回时它们都已 fsync 到磁盘。"""
+        with self.flush_lock:
+            with self.cond:
+                batch, self.pending = self.pending, {}
+                self.writing = batch
+            try:
+                for roomid, entries in batch.items():
+                    self.write(roomid, entries)
+            except BaseException:
+                with self.lock:
+                    # 写入失败的消息放回队列等待重试，已写入的序号会被跳过
+                    for roomid, entries in self.pending.items():
+                        batch.setdefault(roomid, []).extend(entries)
+                    self.pending = batch
+                    self.writing = {}
+                raise
+            with self.lock:
+                self.writing = {}
+                for roomid, entries in batch.items():
+                    if roomid not in self.pending and self.last_seqs.get(roomid) == entries[-1][0]:
+                        del self.last_seqs[roomid]
+            self.prune()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        if self.lock_file is not None:
+            self.flush()
+            self.lock_file.close()
+            self.lock_file = None
+
+    def write(self, roomid, entries):
+        """把按序号升序的 (seq, message) 写入磁盘，已归档的序号会被跳过。"""
+        room_dir = self.room_dir(roomid)
+        with self.write_lock:
+            first_seq, count = self.tails.get(room_dir, (None, 0))
+            next_seq = first_seq + count if first_seq is not None else None
+            lines = []
+            for seq, message in entries:
+                if next_seq is not None and seq < next_seq:
+                    continue
+                if next_seq is None or seq != next_seq or count >= self.segment_messages:
+                    # 序号不连续或分段已满时开始新的分段
+                    self.write_segment(room_dir, first_seq, lines)
+                    first_seq, count, lines = seq, 0, []
+                lines.append(self.encode(seq, message) + b'\n')
+                count += 1
+                next_seq = seq + 1
+            self.write_segment(room_dir, first_seq, lines)
+
+    def write_segment(self, room_dir, first_seq, lines):
+        # 调用者需持有 self.write_lock
+        if not lines:
+            return
+        new_room = not os.path.isdir(room_dir)
+        os.makedirs(room_dir, exist_ok=True)
+        path = os.path.join(room_dir, f'{first_seq:016d}')
+        with open(path + '.ndjson', 'ab') as data_file:
+            offset = data_file.tell()
+            offsets = []
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            data_file.write(b''.join(lines))
+            # 数据落盘后才写索引，断电后索引也不会指向不完整的记录
+            data_file.flush()
+            os.fsync(data_file.fileno())
+        with open(path + '.idx', 'ab') as index_file:
+            index_file.write(struct.pack(f'<{len(offsets)}I', *offsets))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        if offsets[0] == 0:
+            # 新建的文件与目录还需要同步所在目录
+            self.fsync_dir(room_dir)
+            if new_room:
+                self.fsync_dir(self.directory)
+        written = offset - offsets[0] + 4 * len(offsets)
+        tail = self.tails.get(room_dir)
+        if tail is not None and tail[0] == first_seq:
+            tail[1] += len(lines)
+        else:
+            self.tails[room_dir] = [first_seq, len(lines)]
+        entry = self.files.pop(path, [0, 0])
+        self.files[path] = [entry[0] + written, time.time()]
+        self.total += written
+        self.bytes_written += written
+
+    @staticmethod
+    def fsync_dir(path):
+        if os.name != 'posix':
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def prune(self):
+        """删除超过保留期限的分段，总大小超过上限时从最早写入的分段开始删除。"""
+        with self.write_lock:
+            deadline = time.time() - self.retention
+            while self.files:
+                path, (size, modified) = next(iter(self.files.items()))
+                if not (self.retention and modified < deadline) and not (self.max_bytes and self.total > self.max_bytes):
+                    break
+                for suffix in ('.idx', '.ndjson'):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path + suffix)
+                del self.files[path]
+                self.total -= size
+                room_dir, name = os.path.split(path)
+                tail = self.tails.get(room_dir)
+                if tail is not None and tail[0] == int(name):
+                    del self.tails[room_dir]
+
+    def read(self, roomid, before, limit):
+        """返回序号小于 before 的最后 limit 条已写入磁盘的记录（JSON 字节串，按序号升序）。"""
+        lines = []
+        for first_seq in reversed(self.segments(roomid)):
+            if len(lines) >= limit:
+                break
+            if first_seq >= before:
+                continue
+            try:
+                lines[:0] = self.read_segment(self.segment_path(roomid, first_seq), before - first_seq, limit - len(lines))
+            except FileNotFoundError:
+                # 分段刚被清理
+                continue
+        return lines
+
+    def read_segment(self, path, end, limit):
+        with open(path + '.idx', 'rb') as index_file, open(path + '.ndjson', 'rb') as data_file:
+            end = min(end, os.fstat(index_file.fileno()).st_size // 4)
+            start = max(0, end - limit)
+            if start >= end:
+                return []
+            with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index, mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offsets = struct.unpack_from(f'<{end - start}I', index, start * 4)
+                return [data[offset:data.find(b'\n', offset)] for offset in offsets]
+
+    def open_segments(self, roomid):
+        """打开房间的所有分段，返回 [(文件, 完整记录的字节数)] 与最后归档的序号。"""
+        files = []
+        last_seq = 0
+        for first_seq in self.segments(roomid):
+            path = self.segment_path(roomid, first_seq)
+            try:
+                index_file = open(path + '.idx', 'rb')
+                data_file = open(path + '.ndjson', 'rb')
+            except FileNotFoundError:
+                continue
+            with index_file:
+                count = os.fstat(index_file.fileno()).st_size // 4
+                if not count:
+                    data_file.close()
+                    continue
+                offset, = struct.unpack('<I', os.pread(index_file.fileno(), 4, (count - 1) * 4))
+            # 只导出索引中已有的记录，不含正在写入的一行
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                size = data.find(b'\n', offset) + 1
+            files.append((data_file, size))
+            last_seq = first_seq + count - 1
+        return files, last_seq
+
+class JournalChatStore(ChatStore):
+    """基于追加日志的聊天室存储。
+
+    每条新消息追加到日志并 fsync 后才返回，定时把内存状态压缩为快照并清空日志，
+    启动时加载快照后重放日志。首次启动时若只有 INI 文件则从中导入。
+    """
+    def __init__(self, journal_file='chat_records.journal', flush_interval=120, config_file='chat_records.ini'):
+        super().__init__(config_file, flush_interval)
+        self.journal_file = journal_file
+        self.old_journal_file = journal_file + '.old'
+        self.snapshot_file = os.path.splitext(journal_file)[0] + '.snapshot'
+        self.seq = 0
+        self.journal = None
+
+    def load(self):
+        if os.path.exists(self.snapshot_file) or os.path.exists(self.journal_file):
+            snapshot_seq = 0
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, 'r', encoding='utf-8') as snapshot:
+                    data = json.load(snapshot)
+                for roomid, room in data['rooms'].items():
+                    messages = (Message(timestamp, sys.intern(nickname), text) for timestamp, nickname, text in room['messages'])
+                    self.rooms[roomid] = Room(self.max_messages_per_room, messages, room['seq'], room['modified'])
+                self.seq = snapshot_seq = data['seq']
+                self.trim_rooms()
+            # 上次压缩可能在删除旧日志前中断，序号不大于快照的记录已包含在快照中
+            for path in (self.old_journal_file, self.journal_file):
+                for record in Journal.read(path):
+                    if record['seq'] > snapshot_seq:
+                        self.apply_message(record['room'], Message(record['time'], sys.intern(record['nickname']), record['text']))
+                        if 'room_seq' in record:
+                            # 房间序号以日志为准，崩溃前归档的消息可能使重建的房间从更大的序号开始
+                            self.rooms[record['room']].seq = record['room_seq']
+                        self.seq = record['seq']
+        elif os.path.exists(self.config_file):
+            logging.info(f"Importing chat records from {self.config_file}")
+            self.import_ini(self.config_file)
+        # 重放时移出内存的消息不在快照中，删除日志前先写入归档
+        if self.archive is not None:
+            self.archive.flush()
+        # 启动时先落一次快照，之后日志只包含本次运行的新消息
+        self.write_snapshot(self.dump_rooms(), self.seq)
+        for path in (self.old_journal_file, self.journal_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self.journal = Journal(self.journal_file)
+        self.dirty = False
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                rooms = self.dump_rooms()
+                seq = self.seq
+                self.dirty = False
+                self.journal.rotate(self.old_journal_file)
+            # 快照不含已移出内存的消息，删除旧日志前先把它们写入归档并落盘
+            if self.archive is not None:
+                self.archive.flush()
+            self.write_snapshot(rooms, seq)
+            os.remove(self.old_journal_file)
+
+    def dump_rooms(self):
+        return {roomid: {'seq': room.seq, 'modified': room.modified, 'messages': [(message.time, message.nickname, message.text) for message in room.messages]} for roomid, room in self.rooms.items()}
+
+    def write_snapshot(self, rooms, seq):
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as snapshot:
+            json.dump({'seq': seq, 'rooms': rooms}, snapshot, ensure_ascii=False)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+            self.bytes_written += snapshot.tell()
+        os.replace(temp_file, self.snapshot_file)
+
+    def close(self):
+        super().close()
+        self.journal.close()
+
+    def log_message(self, roomid, message):
+        self.seq += 1
+        return self.journal.enqueue({'seq': self.seq, 'room': roomid, 'room_seq': self.rooms[roomid].seq, 'time': message.time, 'nickname': message.nickname, 'text': message.text})
+
+    def commit(self, ticket):
+        self.journal.wait(ticket)
+
+    def stats(self):
+        stats = super().stats()
+        # 逐条追加的日志也计入写入字节数
+        stats['bytes_written'] += self.journal.bytes_written
+        return stats
+
+class SqliteDatabase:
+    """SQLite 数据库（WAL 模式），每个线程使用自己的连接，可由多个进程同时访问。"""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # 每次提交都落盘，已确认的消息不会因断电丢失
+            db.execute('PRAGMA synchronous=FULL')
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.connection()
+        # 立即获取写锁，避免多个进程读后写时发生死锁
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+class SqliteChatStore(ChatStore):
+    """保存在 SQLite 中的聊天室存储，供多个工作进程共享。
+
+    消息、房间淘汰与序号都在数据库事务中完成。每个进程的后台线程定时检查
+    数据库是否被其他进程修改，并为变化的房间通知监听器与长轮询等待者。
+    首次创建数据库时若存在 INI 文件则从中导入。
+    """
+    def __init__(self, db_file='chat_records.db', sync_interval=0.5, config_file='chat_records.ini'):
+        super().__init__(config_file, sync_interval)
+        self.database = SqliteDatabase(db_file)
+        # 本进程已知的各房间序号，用于发现其他进程的修改
+        self.known = {}
+
+    def load(self):
+        with self.database.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS rooms (roomid TEXT PRIMARY KEY, seq INTEGER NOT NULL, modified REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS rooms_modified ON rooms (modified)')
+            db.execute('CREATE TABLE IF NOT EXISTS messages (roomid TEXT NOT NULL, seq INTEGER NOT NULL, time REAL NOT NULL, nickname TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (roomid, seq)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, last REAL NOT NULL, state TEXT NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS rate_limits_last ON rate_limits (last)')
+            # 移出内存窗口、等待写入归档的消息，以及各房间已移出的最大序号
+            db.execute('CREATE TABLE IF NOT EXISTS archive_queue (roomid TEXT NOT NULL, seq INTEGER NOT NULL, time REAL NOT NULL, nickname TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (roomid, seq)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS archive_seqs (roomid TEXT PRIMARY KEY, seq INTEGER NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS metrics (pid INTEGER PRIMARY KEY, updated REAL NOT NULL, families TEXT NOT NULL)')
+            created = db.execute("SELECT value FROM meta WHERE key = 'created'").fetchone()
+            if created is None:
+                db.execute("INSERT INTO meta (key, value) VALUES ('created', ?)", (str(time.time()),))
+                if os.path.exists(self.config_file):
+                    logging.info(f"Importing chat records from {self.config_file}")
+                    self.import_ini(self.config_file)
+            self.trim_rooms()
+        with self.lock:
+            self.known = dict(self.database.connection().execute('SELECT roomid, seq FROM rooms'))
+        self.dirty = False
+
+    def save(self):
+        # 每条消息在事务中已经落盘
+        self.dirty = False
+
+    def start(self):
+        self.flush_thread = threading.Thread(target=self.watch_changes, name='chat-sync', daemon=True)
+        self.flush_thread.start()
+
+    def watch_changes(self):
+        db = self.database.connection()
+        last_version = None
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                # 只有取得归档目录锁的进程把归档队列写入磁盘
+                if self.archive is not None and self.archive.acquire():
+                    self.drain_archive_queue()
+                # data_version 只在其他连接提交后变化
+                version = db.execute('PRAGMA data_version').fetchone()[0]
+                if version == last_version:
+                    continue
+                last_version = version
+                seqs = dict(db.execute('SELECT roomid, seq FROM rooms'))
+                with self.lock:
+                    changed = [roomid for roomid, seq in seqs.items() if self.known.get(roomid) != seq]
+                    removed = [roomid for roomid in self.known if roomid not in seqs]
+                    self.known = seqs
+                    for roomid in changed + removed:
+                        self.notify(roomid)
+            except Exception as e:
+                logging.error(f"Error checking chat records for changes: {e}")
+
+    def close(self):
+        super().close()
+        self.database.close()
+
+    def add_message(self, roomid, nickname, message):
+        message = Message(time.time(), sys.intern(nickname), message)
+        with self.database.transaction() as db:
+            evicted, seq = self.insert_message(db, roomid, message)
+        with self.lock:
+            if evicted is not None:
+                self.known.pop(evicted, None)
+                self.evictions += 1
+                self.notify(evicted)
+            self.known[roomid] = max(seq, self.known.get(roomid, 0))
+            self.notify(roomid)
+
+    def insert_message(self, db, roomid, message):
+        evicted = None
+        row = db.execute('SELECT seq FROM rooms WHERE roomid = ?', (roomid,)).fetchone()
+        if row is None:
+            if db.execute('SELECT COUNT(*) FROM rooms').fetchone()[0] >= self.max_rooms:
+                # 淘汰最久没有新消息的房间
+                evicted = db.execute('SELECT roomid FROM rooms ORDER BY modified LIMIT 1').fetchone()[0]
+                self.delete_room(db, evicted)
+            # 序号接着已归档的消息继续，避免与归档重复
+            seq = self.archived_seq(db, roomid) + 1
+        else:
+            seq = row[0] + 1
+        db.execute('INSERT OR REPLACE INTO rooms (roomid, seq, modified) VALUES (?, ?, ?)', (roomid, seq, message.time))
+        db.execute('INSERT INTO messages (roomid, seq, time, nickname, text) VALUES (?, ?, ?, ?, ?)', (roomid, seq, message.time, message.nickname, message.text))
+        self.archive_messages(db, roomid, seq - self.max_messages_per_room)
+        db.execute('DELETE FROM messages WHERE roomid = ? AND seq <= ?', (roomid, seq - self.max_messages_per_room))
+        return evicted, seq
+
+    def archive_messages(self, db, roomid, last_seq):
+        # 在写事务中只把消息移入归档队列，由 drain_archive_queue 在事务外写入磁盘
+        if self.archive is not None:
+            db.execute('INSERT OR IGNORE INTO archive_queue (roomid, seq, time, nickname, text) SELECT roomid, seq, time, nickname, text FROM messages WHERE roomid = ? AND seq <= ?', (roomid, last_seq))
+            archived = db.execute('SELECT MAX(seq) FROM messages WHERE roomid = ? AND seq <= ?', (roomid, last_seq)).fetchone()[0]
+            if archived is not None:
+                db.execute('INSERT OR REPLACE INTO archive_seqs (roomid, seq) VALUES (?, ?)', (roomid, archived))
+
+    def archived_seq(self, db, roomid):
+        if self.archive is None:
+            return 0
+        row = db.execute('SELECT seq FROM archive_seqs WHERE roomid = ?', (roomid,)).fetchone()
+        return row[0] if row else 0
+
+    def drain_archive_queue(self):
+        db = self.database.connection()
+        rows = db.execute('SELECT roomid, seq, time, nickname, text FROM archive_queue ORDER BY roomid, seq LIMIT 10000').fetchall()
+        written = []
+        for roomid, group in groupby(rows, key=lambda row: row[0]):
+            entries = [(seq, Message(timestamp, nickname, text)) for _, seq, timestamp, nickname, text in group]
+            self.archive.write(roomid, entries)
+            written.append((roomid, entries[-1][0]))
+        if written:
+            # write() 返回时分段已 fsync，之后才从队列删除；中途崩溃时重复写入的序号会被跳过
+            with self.database.transaction() as db:
+                db.executemany('DELETE FROM archive_queue WHERE roomid = ? AND seq <= ?', written)
+        self.archive.prune()
+
+    def delete_room(self, db, roomid):
+        self.archive_messages(db, roomid, sys.maxsize)
+        db.execute('DELETE FROM messages WHERE roomid = ?', (roomid,))
+        db.execute('DELETE FROM rooms WHERE roomid = ?', (roomid,))
+
+    def put_room(self, roomid, messages):
+        # 只在 load() 或导入的事务中调用
+        db = self.database.connection()
+        messages = messages[-self.max_messages_per_room:]
+        self.delete_room(db, roomid)
+        base = self.archived_seq(db, roomid)
+        modified = messages[-1].time if messages else time.time()
+        db.execute('INSERT INTO rooms (roomid, seq, modified) VALUES (?, ?, ?)', (roomid, base + len(messages), modified))
+        db.executemany('INSERT INTO messages (roomid, seq, time, nickname, text) VALUES (?, ?, ?, ?, ?)', [(roomid, seq, message.time, message.nickname, message.text) for seq, message in enumerate(messages, base + 1)])
+
+    def import_ini(self, path):
+        db = self.database.connection()
+        if db.in_transaction:
+            super().import_ini(path)
+        else:
+            with self.database.transaction():
+                super().import_ini(path)
+
+    def trim_rooms(self):
+        # 只在 load() 或导入的事务中调用
+        db = self.database.connection()
+        excess = db.execute('SELECT COUNT(*) FROM rooms').fetchone()[0] - self.max_rooms
+        if excess > 0:
+            for (roomid,) in db.execute('SELECT roomid FROM rooms ORDER BY modified LIMIT ?', (excess,)).fetchall():
+                self.delete_room(db, roomid)
+
+    def iter_rooms(self):
+        db = self.database.connection()
+        rooms = []
+        for (roomid,) in db.execute('SELECT roomid FROM rooms ORDER BY modified').fetchall():
+            rows = db.execute('SELECT time, nickname, text FROM messages WHERE roomid = ? ORDER BY seq', (roomid,))
+            rooms.append((roomid, [Message(*row) for row in rows]))
+        return rooms
+
+    def get_unarchived(self, roomid):
+        db = self.database.connection()
+        rows = db.execute('SELECT seq, time, nickname, text FROM archive_queue WHERE roomid = ? UNION ALL SELECT seq, time, nickname, text FROM messages WHERE roomid = ? ORDER BY seq', (roomid, roomid))
+        return [(seq, Message(timestamp, nickname, text)) for seq, timestamp, nickname, text in rows]
+
+    def get_messages(self, roomid, since=0):
+        db = self.database.connection()
+        row = db.execute('SELECT seq, modified FROM rooms WHERE roomid = ?', (roomid,)).fetchone()
+        if row is None:
+            return 0, None, []
+        seq, modified = row
+        # 游标无效（例如房间被重建）时返回全部消息
+        if since <= 0 or since > seq:
+            since = 0
+        rows = db.execute('SELECT time, nickname, text FROM messages WHERE roomid = ? AND seq > ? ORDER BY seq', (roomid, since))
+        return seq, modified, [Message(*row) for row in rows]
+
+    def get_seq(self, roomid):
+        return self.known.get(roomid)
+
+    def stats(self):
+        db = self.database.connection()
+        rooms = db.execute('SELECT COUNT(*) FROM rooms').fetchone()[0]
+        messages = db.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        # 消息在各自的事务中写入，没有定时保存；淘汰数只统计本进程
+        return {'rooms': rooms, 'messages': messages, 'evictions': self.evictions, 'saves': self.saves, 'save_seconds': self.save_seconds, 'bytes_written': self.bytes_written}
+
+class Subscriber:
+    """一个 SSE 连接的待发送事件队列。"""
+    __slots__ = ('roomid', 'events', 'cond', 'max_events', 'dropped', 'closed')
+
+    def __init__(self, roomid, max_events):
+        self.roomid = roomid
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.max_events = max_events
+        self.dropped = False
+        self.closed = False
+
+    def push(self, event):
+        with self.cond:
+            if len(self.events) >= self.max_events:
+                # 消费过慢，断开后由客户端凭 Last-Event-ID 重连补齐
+                self.dropped = True
+            else:
+                self.events.append(event)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def pop_events(self, timeout):
+        """等待并取出所有待发送事件；超时返回空列表，已断开返回 None。"""
+        with self.cond:
+            if not self.events and not self.dropped and not self.closed:
+                self.cond.wait(timeout)
+            if self.dropped or self.closed:
+                return None
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+class StreamHub:
+    """按房间登记的 SSE 订阅者，新消息到达时分发给该房间的所有订阅者。
+
+    分发只把事件放入各订阅者的有界队列，不会阻塞发送消息的请求。
+    """
+    def __init__(self, store, max_subscribers=1000, max_events=100):
+        self.store = store
+        self.max_subscribers = max_subscribers
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.rooms = {}
+        # 每个房间已分发到的序号
+        self.published = {}
+        self.count = 0
+
+    def subscribe(self, roomid):
+        """登记订阅者；订阅者已满时返回 None。"""
+        with self.lock:
+            if self.count >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(roomid, self.max_events)
+            if roomid not in self.rooms:
+                # 首个订阅者只需要此后的新消息，积压消息由 stream_messages 自行读取
+                self.published[roomid] = self.store.get_seq(roomid) or 0
+            self.rooms.setdefault(roomid, set()).add(subscriber)
+            self.count += 1
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.rooms.get(subscriber.roomid)
+            if subscribers is not None and subscriber in subscribers:
+                subscribers.discard(subscriber)
+                self.count -= 1
+                if not subscribers:
+                    del self.rooms[subscriber.roomid]
+                    self.published.pop(subscriber.roomid, None)
+
+    def publish(self, roomid):
+        # 作为 ChatStore 的监听器在持有存储锁时调用
+        with self.lock:
+            subscribers = list(self.rooms.get(roomid, ()))
+            published = self.published.get(roomid, 0)
+        if not subscribers:
+            return
+        seq, _, messages = self.store.get_messages(roomid, published)
+        if seq == 0:
+            # 房间被淘汰，让订阅者重连
+            for subscriber in subscribers:
+                subscriber.close()
+            return
+        # 一次可能有多条新消息（例如由其他工作进程写入），订阅者按序号去重
+        first_seq = seq - len(messages) + 1
+        events = [(first_seq + index, message.format()) for index, message in enumerate(messages)]
+        with self.lock:
+            self.published[roomid] = seq
+        for subscriber in subscribers:
+            for event in events:
+                subscriber.push(event)
+
+    def close(self):
+        with self.lock:
+            subscribers = [subscriber for subscribers in self.rooms.values() for subscriber in subscribers]
+        for subscriber in subscribers:
+            subscriber.close()
+
+class RateLimiter:
+    """按键限流的基类，每次检查只做常数量的工作。
+
+    键按最近使用排序，空闲超过 idle_time 的键在后续检查时顺带清除，
+    键数量超过 max_keys 时淘汰最久未用的键，使内存占用保持有界。
+    """
+    def __init__(self, limit, period=60, max_keys=100000):
+        self.limit = limit
+        self.period = period
+        self.max_keys = max_keys
+        self.idle_time = period
+        self.lock = threading.Lock()
+        self.states = OrderedDict()
+        self.rejections = 0
+
+    def check(self, key):
+        """允许时返回 0，否则返回需要等待的秒数。"""
+        now = time.monotonic()
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = self.new_state(now)
+            else:
+                self.states.move_to_end(key)
+            retry_after = self.consume(state, now)
+            state[0] = now
+            if retry_after:
+                self.rejections += 1
+            self.sweep(now)
+            return retry_after
+
+    def sweep(self, now):
+        # 调用者需持有 self.lock；最前面的键空闲最久，遇到活跃的键即可停止
+        while self.states:
+            state = next(iter(self.states.values()))
+            if now - state[0] < self.idle_time and len(self.states) <= self.max_keys:
+                break
+            self.states.popitem(last=False)
+
+    def new_state(self, now):
+        raise NotImplementedError
+
+    def consume(self, state, now):
+        raise NotImplementedError
+
+class TokenBucketLimiter(RateLimiter):
+    """令牌桶：容量为 limit，每 period 秒匀速补满。
+
+    state 为 [最后使用时间, 剩余令牌]。
+    """
+    def new_state(self, now):
+        return [now, float(self.limit)]
+
+    def consume(self, state, now):
+        rate = self.limit / self.period
+        tokens = min(self.limit, state[1] + (now - state[0]) * rate)
+        if tokens >= 1:
+            state[1] = tokens - 1
+            return 0
+        state[1] = tokens
+        return (1 - tokens) / rate
+
+class SlidingWindowLimiter(RateLimiter):
+    """滑动窗口计数：用上一窗口计数按时间加权估算最近 period 秒内的请求数。
+
+    state 为 [最后使用时间, 窗口编号, 本窗口计数, 上一窗口计数]。
+    """
+    def __init__(self, limit, period=60, max_keys=100000):
+        super().__init__(limit, period, max_keys)
+        # 空闲两个窗口后计数全部清零
+        self.idle_time = 2 * period
+
+    def new_state(self, now):
+        return [now, int(now // self.period), 0, 0]
+
+    def consume(self, state, now):
+        window = int(now // self.period)
+        if window != state[1]:
+            state[3] = state[2] if window == state[1] + 1 else 0
+            state[2] = 0
+            state[1] = window
+        elapsed = now - window * self.period
+        current, previous = state[2], state[3]
+        if previous * (self.period - elapsed) / self.period + current + 1 <= self.limit:
+            state[2] += 1
+            return 0
+        # 计算估算值降到 limit - 1 以下所需的时间
+        allowance = self.limit - 1 - current
+        if allowance >= 0 and previous:
+            return self.period - elapsed - allowance * self.period / previous
+        return self.period - elapsed + self.period * max(0.0, 1 - (self.limit - 1) / current)
+
+class SqliteRateLimiter:
+    """多个工作进程共享的限流器：算法由 limiter 提供，状态保存在 SQLite 中。"""
+    def __init__(self, limiter, database):
+        self.limiter = limiter
+        self.database = database
+        self.rejections = 0
+        self.last_sweep = 0
+
+    def check(self, key):
+        """允许时返回 0，否则返回需要等待的秒数。"""
+        # 不同进程需要可比较的时间，使用系统时间
+        now = time.time()
+        key = json.dumps(key, ensure_ascii=False)
+        with self.database.transaction() as db:
+            row = db.execute('SELECT state FROM rate_limits WHERE key = ?', (key,)).fetchone()
+            state = json.loads(row[0]) if row else self.limiter.new_state(now)
+            retry_after = self.limiter.consume(state, now)
+            state[0] = now
+            db.execute('INSERT OR REPLACE INTO rate_limits (key, last, state) VALUES (?, ?, ?)', (key, now, json.dumps(state)))
+            if now - self.last_sweep >= self.limiter.idle_time:
+                # 定期清除空闲的键
+                self.last_sweep = now
+                db.execute('DELETE FROM rate_limits WHERE last < ?', (now - self.limiter.idle_time,))
+        if retry_after:
+            self.rejections += 1
+        return retry_after
+
+class Metrics:
+    """请求计数、延迟直方图与活动连接数，由 /metrics 以 Prometheus 文本格式输出。
+
+    只在启用 --metrics 时创建；未启用时每个请求只多一次 None 判断。
+    多进程时每个工作进程定时把自己的样本写入共享数据库，任一进程响应 /metrics 时
+    合并所有存活进程的样本，并以 pid 标签区分，保证每次抓取都能看到全部计数。
+    房间数与消息数反映共享的存储，不带 pid 标签，只输出响应进程的一份。
+    """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    # 路由标签只取固定集合，避免任意路径使指标无限增多
+    routes = frozenset(('/', '/chat', '/log', '/stream', '/history', '/export', '/send_message', '/metrics', '/lb-chat.css', '/main.js', '/log.js', '/favicon.ico'))
+    # 多进程时写入共享数据库的间隔（秒），超过三个间隔未更新的进程视为已退出
+    publish_interval = 5
+    # 反映共享存储而非单个进程的指标
+    shared = frozenset(('chat_rooms', 'chat_messages'))
+
+    def __init__(self, store, log_cache, rate_limiter, stream_hub, database=None):
+        self.store = store
+        self.log_cache = log_cache
+        self.rate_limiter = rate_limiter
+        self.stream_hub = stream_hub
+        self.database = database
+        self.lock = threading.Lock()
+        # (method, route, status) -> 请求数
+        self.requests = {}
+        # (method, route) -> 各区间计数（最后一个区间为 +Inf）加耗时总和
+        self.durations = {}
+        self.connections = 0
+        self.pid = os.getpid()
+        self.stop_event = threading.Event()
+        self.publish_thread = None
+
+    def route(self, path):
+        path = path.split('?', 1)[0]
+        if path == '/index.html':
+            return '/'
+        return path if path in self.routes else 'other'
+
+    def observe_request(self, method, path, status, seconds):
+        route = self.route(path)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get((method, route))
+            if histogram is None:
+                histogram = self.durations[(method, route)] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def collect(self):
+        """返回本进程的指标：[(名称, 类型, 说明, [(样本名, 标签, 值)])]。"""
+        families = []
+
+        def family(name, kind, description):
+            samples = []
+            families.append((name, kind, description, samples))
+            return samples
+
+        with self.lock:
+            requests = sorted(self.requests.items())
+            durations = sorted((key, list(histogram)) for key, histogram in self.durations.items())
+            connections = self.connections
+
+        samples = family('chat_http_requests_total', 'counter', 'HTTP requests by method, route and status.')
+        for (method, route, status), count in requests:
+            samples.append(('chat_http_requests_total', {'method': method, 'route': route, 'status': status}, count))
+        samples = family('chat_http_request_duration_seconds', 'histogram', 'Time spent handling HTTP requests.')
+        for (method, route), histogram in durations:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                total += count
+                samples.append(('chat_http_request_duration_seconds_bucket', {'method': method, 'route': route, 'le': bound}, total))
+            samples.append(('chat_http_request_duration_seconds_sum', {'method': method, 'route': route}, histogram[-1]))
+            samples.append(('chat_http_request_duration_seconds_count', {'method': method, 'route': route}, total))
+
+        stats = self.store.stats()
+        cache = self.log_cache.stats()
+        for name, kind, description, value in (
+            ('chat_http_connections_active', 'gauge', 'Open client connections.', connections),
+            ('chat_rooms', 'gauge', 'Rooms currently stored.', stats['rooms']),
+            ('chat_messages', 'gauge', 'Messages currently stored.', stats['messages']),
+            ('chat_rooms_evicted_total', 'counter', 'Rooms evicted to stay under the room limit.', stats['evictions']),
+            ('chat_saves_total', 'counter', 'Periodic saves of chat records.', stats['saves']),
+            ('chat_save_seconds_total', 'counter', 'Time spent in periodic saves of chat records.', stats['save_seconds']),
+            ('chat_bytes_written_total', 'counter', 'Bytes written to chat record files.', stats['bytes_written']),
+            ('chat_rate_limit_rejections_total', 'counter', 'Messages rejected by the rate limiter.', self.rate_limiter.rejections if self.rate_limiter else 0),
+            ('chat_log_cache_entries', 'gauge', 'Rendered chat logs in the cache.', cache['entries']),
+            ('chat_log_cache_bytes', 'gauge', 'Memory used by cached chat logs.', cache['bytes']),
+            ('chat_log_cache_hits_total', 'counter', 'Chat log cache hits.', cache['hits']),
+            ('chat_log_cache_misses_total', 'counter', 'Chat log cache misses.', cache['misses']),
+            ('chat_log_cache_evictions_total', 'counter', 'Chat logs evicted from the cache.', cache['evictions']),
+            ('chat_stream_subscribers', 'gauge', 'Open /stream connections.', self.stream_hub.count),
+        ):
+            family(name, kind, description).append((name, {}, value))
+        for name, _, _, samples in families:
+            if name in self.shared:
+                continue
+            for _, labels, _ in samples:
+                labels['pid'] = self.pid
+        return families
+
+    def start(self):
+        if self.database is not None:
+            self.publish_thread = threading.Thread(target=self.publish_periodically, name='metrics-publisher', daemon=True)
+            self.publish_thread.start()
+
+    def publish_periodically(self):
+        while not self.stop_event.wait(self.publish_interval):
+            try:
+                self.publish(self.collect())
+            except Exception as e:
+                logging.error(f"Error publishing metrics: {e}")
+
+    def publish(self, families):
+        with self.database.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO metrics (pid, updated, families) VALUES (?, ?, ?)', (self.pid, time.time(), json.dumps(families)))
+
+    def close(self):
+        self.stop_event.set()
+        if self.publish_thread is not None:
+            self.publish_thread.join()
+            with self.database.transaction() as db:
+                db.execute('DELETE FROM metrics WHERE pid = ?', (self.pid,))
+
+    def render(self):
+        families = self.collect()
+        if self.database is not None:
+            self.publish(families)
+            with self.database.transaction() as db:
+                db.execute('DELETE FROM metrics WHERE updated < ?', (time.time() - 3 * self.publish_interval,))
+                rows = db.execute('SELECT families FROM metrics WHERE pid != ? ORDER BY pid', (self.pid,)).fetchall()
+            # 按名称合并各进程的同名指标，HELP 与 TYPE 只输出一次
+            merged = {name: (kind, description, list(samples)) for name, kind, description, samples in families}
+            for (data,) in rows:
+                for name, kind, description, samples in json.loads(data):
+                    if name in self.shared:
+                        continue
+                    merged.setdefault(name, (kind, description, []))[2].extend(samples)
+            families = [(name, kind, description, samples) for name, (kind, description, samples) in merged.items()]
+        lines = []
+        for name, kind, description, samples in families:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample, labels, value in samples:
+                if labels:
+                    sample += '{' + ','.join(f'{key}="{label}"' for key, label in labels.items()) + '}'
+                lines.append(f'{sample} {value}')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def timed(handler):
+    """启用指标时记录 do_GET/do_POST 的耗时与状态码。"""
+    @functools.wraps(handler)
+    def wrapper(self):
+        metrics = self.metrics
+        if metrics is None:
+            return handler(self)
+        self.status = 0
+        started = time.perf_counter()
+        try:
+            return handler(self)
+        finally:
+            metrics.observe_request(self.command, self.path, int(self.status), time.perf_counter() - started)
+    return wrapper
+
+# 访问日志经队列交给后台线程写出，请求线程不直接写 stderr
+access_log = logging.getLogger('access')
+access_log.propagate = False
+
+def start_access_log():
+    log_queue = queue.SimpleQueue()
+    access_log.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stderr))
+    listener.start()
+    return listener
+
+class ChatServer(http.server.BaseHTTPRequestHandler):
+    # 使用 HTTP/1.1 以支持持久连接，所有响应都必须带 Content-Length
+    protocol_version = 'HTTP/1.1'
+    # SSE 与导出分多次写入，关闭 Nagle 算法以免后续的小包等待前一次写入的 ACK
+    disable_nagle_algorithm = True
+    # 空闲持久连接的超时时间（秒），超时后释放连接
+    keep_alive_timeout = 15
+    timeout = keep_alive_timeout
+    # 由 main() 在启动时创建，所有请求共享同一个存储、聊天记录缓存与推送中心
+    store = None
+    log_cache = None
+    stream_hub = None
+    stream_heartbeat_interval = 15
     max_message_length = 1024
     max_messages_per_minute = 45
     max_cache_time = 86400
     auto_refresh_interval = 60
-    message_rate_limit = {}  # To track messages per minute
+    max_long_poll_time = 30
+    # 线程池或单线程模式下为 False：长轮询与实时推送会长期占用有限的处理线程
+    blocking_requests = True
+    # /history 每页默认与最多返回的消息数
+    history_page_size = 50
+    max_history_page = 500
+    # 由 main() 在启动时创建；限流键由 rate_limit_by 中的 ip、nickname、room 组合而成
+    rate_limiter = None
+    rate_limit_by = ('ip', 'room')
+    # 位于反向代理之后时，从该请求头读取客户端 IP
+    real_ip_header = None
+    # 可信反向代理的层数：每层代理都在 X-Forwarded-For 末尾追加它看到的地址
+    trusted_proxies = 1
+    # 由 main() 在启用 --metrics 时创建
+    metrics = None
+    # 记录访问日志的请求比例，0 表示不记录
+    access_log_sample = 1.0
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.load_rooms()
+    def setup(self):
+        super().setup()
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.metrics is not None:
+                self.metrics.connection_closed()
 
-        # 创建一个线程，每 120 秒保存一次聊天数据
-        self.save_thread = threading.Thread(target=self.save_rooms_periodically)
-        self.save_thread.daemon = True
-        self.save_thread.start()
+    def log_request(self, code='-', size='-'):
+        # send_response 每次都会调用，顺便记下状态码供指标使用
+        self.status = code if isinstance(code, int) else 0
+        if self.access_log_sample >= 1 or random.random() < self.access_log_sample:
+            super().log_request(code, size)
 
+    def log_message(self, format, *args):
+        access_log.info("%s - - [%s] %s", self.address_string(), self.log_date_time_string(), format % args)
+
+    @timed
     def do_GET(self):
         try:
             if self.path.startswith('/./'):
-                self.send_response(301)
-                self.send_header('Location', self.path[2:])
-                self.end_headers()
+                self.send_redirect(301, self.path[2:])
             elif self.path == '/' or self.path == '/index.html' or self.path.startswith('/?') or self.path.startswith('/index.html'):
                 query_string = urlparse(self.path).query
                 query_params = parse_qs(query_string)
                 nickname = query_params.get('nickname', [''])[0]
                 roomid = query_params.get('roomid', [''])[0]
                 lang = query_params.get('lang', [self.get_preferred_language()])[0]
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.send_header('Cache-Control', f'public, max-age={self.max_cache_time}')
-                self.end_headers()
-                self.wfile.write(self.generate_home_html(nickname, roomid, lang))
+                self.send_content(self.generate_home_html(nickname, roomid, lang), 'text/html; charset=utf-8', f'public, max-age={self.max_cache_time}')
             elif self.path.startswith('/chat'):
                 query_params = parse_qs(urlparse(self.path).query)
                 nickname = query_params.get('nickname', ['匿名'])[0]
@@ -69,13 +1655,8 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
                     self.send_msg_error(400, "Bad Request: RoomID contains illegal characters.<br>房间号包含非法字符。")
                     return
 
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.send_header('Cache-Control', f'public, max-age={self.max_cache_time}')
-                self.end_headers()
-                self.wfile.write(self.generate_chat_html(nickname, roomid, message, lang))
+                self.send_content(self.generate_chat_html(nickname, roomid, message, lang), 'text/html; charset=utf-8', f'public, max-age={self.max_cache_time}')
             elif self.path.startswith('/log?'):
-                print(self.path)
                 query_params = parse_qs(urlparse(self.path).query)
                 roomid = query_params.get('id', ['默认'])[0]
                 lang = query_params.get('lang', [self.get_preferred_language()])[0]
@@ -86,41 +1667,115 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
                     self.send_msg_error(400, "Bad Request: RoomID contains illegal characters.<br>房间号包含非法字符。")
                     return
 
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.send_header('Cache-Control', 'public, max-age=6')
-                self.end_headers()
-                self.wfile.write(self.generate_chat_log_html(roomid, lang))
+                try:
+                    since = int(query_params.get('since', ['0'])[0])
+                    wait = min(float(query_params.get('wait', ['0'])[0]), self.max_long_poll_time)
+                except ValueError:
+                    self.send_msg_error(400, "Bad Request: Invalid since or wait.<br>since 或 wait 参数无效。")
+                    return
+
+                # 长轮询：没有新消息时挂起请求，直到有新消息或超时
+                if wait > 0 and self.blocking_requests:
+                    self.store.wait_for_messages(roomid, since, wait)
+                # 页面只区分中文与英文，按此归一化以免缓存键随任意 lang 值膨胀
+                lang = 'zh' if lang == 'zh' else 'en'
+                seq, modified, messages = self.store.get_messages(roomid, since)
+
+                headers = {'ETag': f'W/"{seq}-{int((modified or 0) * 1000)}-{lang}"', 'X-Chat-Seq': str(seq), 'Vary': 'Accept-Language, Accept-Encoding'}
+                if modified is not None:
+                    headers['Last-Modified'] = formatdate(modified, usegmt=True)
+                if self.is_not_modified(headers['ETag'], modified):
+                    self.send_not_modified('public, max-age=6', headers)
+                    return
+                if since > 0:
+                    # 增量结果因游标而异，不进入缓存
+                    self.send_content(self.generate_chat_log_html(roomid, messages, seq, lang, since), 'text/html; charset=utf-8', 'public, max-age=6', headers=headers)
+                    return
+                entry = self.log_cache.get(roomid, lang, (seq, modified))
+                headers['X-Cache'] = 'HIT' if entry else 'MISS'
+                if entry is None:
+                    entry = self.log_cache.put(roomid, lang, (seq, modified), self.generate_chat_log_html(roomid, messages, seq, lang))
+                if self.accepts_encoding('gzip'):
+                    headers['Content-Encoding'] = 'gzip'
+                    body = self.log_cache.get_gzip(entry)
+                else:
+                    body = entry.body
+                self.send_content(body, 'text/html; charset=utf-8', 'public, max-age=6', headers=headers)
+            elif self.path.startswith('/stream?'):
+                query_params = parse_qs(urlparse(self.path).query)
+                roomid = query_params.get('id', ['默认'])[0]
+
+                # 检查非法字符
+                illegal_chars = ['<', '>', '&', '"', "'", "\\"]
+                if any(char in roomid for char in illegal_chars):
+                    self.send_msg_error(400, "Bad Request: RoomID contains illegal characters.<br>房间号包含非法字符。")
+                    return
+
+                try:
+                    # 断线重连时浏览器通过 Last-Event-ID 告知已收到的序号
+                    since = int(self.headers.get('Last-Event-ID') or query_params.get('since', ['0'])[0])
+                except ValueError:
+                    self.send_msg_error(400, "Bad Request: Invalid since.<br>since 参数无效。")
+                    return
+                self.stream_messages(roomid, since)
+            elif self.path.startswith('/history?'):
+                query_params = parse_qs(urlparse(self.path).query)
+                roomid = query_params.get('id', ['默认'])[0]
+
+                # 检查非法字符
+                illegal_chars = ['<', '>', '&', '"', "'", "\\"]
+                if any(char in roomid for char in illegal_chars):
+                    self.send_msg_error(400, "Bad Request: RoomID contains illegal characters.<br>房间号包含非法字符。")
+                    return
+
+                try:
+                    before = int(query_params.get('before', ['0'])[0])
+                    limit = max(1, min(int(query_params.get('limit', [self.history_page_size])[0]), self.max_history_page))
+                except ValueError:
+                    self.send_msg_error(400, "Bad Request: Invalid before or limit.<br>before 或 limit 参数无效。")
+                    return
+                lines = self.store.get_history(roomid, before, limit)
+                # 满页时用本页首条消息的序号继续向前翻页
+                next_before = json.loads(lines[0])['seq'] if len(lines) == limit else None
+                if next_before is not None and next_before <= 1:
+                    next_before = None
+                headers = {'X-Next-Before': str(next_before)} if next_before else {}
+                if query_params.get('format', ['json'])[0] == 'ndjson':
+                    self.send_content(b''.join(line + b'\n' for line in lines), 'application/x-ndjson; charset=utf-8', 'public, max-age=6', headers=headers)
+                else:
+                    body = f'{{"room": {json.dumps(roomid, ensure_ascii=False)}, "next_before": {json.dumps(next_before)}, "messages": ['.encode('utf-8') + b', '.join(lines) + b']}'
+                    self.send_content(body, 'application/json; charset=utf-8', 'public, max-age=6', headers=headers)
+            elif self.path.startswith('/export?'):
+                roomid = parse_qs(urlparse(self.path).query).get('id', ['默认'])[0]
+
+                # 检查非法字符
+                illegal_chars = ['<', '>', '&', '"', "'", "\\"]
+                if any(char in roomid for char in illegal_chars):
+                    self.send_msg_error(400, "Bad Request: RoomID contains illegal characters.<br>房间号包含非法字符。")
+                    return
+
+                self.send_export(roomid)
+            elif self.path == '/metrics' and self.metrics is not None:
+                self.send_content(self.metrics.render(), 'text/plain; version=0.0.4; charset=utf-8', 'no-store')
             elif self.path == '/lb-chat.css':
-                self.send_response(200)
-                self.send_header('X-Content-Type-Options', 'nosniff')
-                self.send_header('Content-type', 'text/css')
-                self.send_header('Cache-Control', f'public, max-age={self.max_cache_time}')
-                self.end_headers()
-                self.wfile.write(self.generate_css())
+                self.send_asset(self.assets[self.path], {'X-Content-Type-Options': 'nosniff'})
             elif self.path == '/main.js':
-                self.send_response(200)
-                self.send_header('X-Content-Type-Options', 'nosniff')
-                self.send_header('Content-type', 'text/javascript')
-                self.send_header('Cache-Control', f'public, max-age={self.max_cache_time}')
-                self.end_headers()
-                self.wfile.write(self.generate_js())
+                self.send_asset(self.assets[self.path], {'X-Content-Type-Options': 'nosniff'})
+            elif self.path == '/log.js':
+                self.send_asset(self.assets[self.path], {'X-Content-Type-Options': 'nosniff'})
             elif self.path == '/favicon.ico':
-                self.send_response(200)
-                self.send_header('Content-type', 'image/svg+xml')
-                self.send_header('Cache-Control', f'public, max-age={self.max_cache_time}')
-                self.end_headers()
-                self.wfile.write(self.generate_favicon())
+                self.send_asset(self.assets[self.path])
             else:
                 self.send_msg_error(404, "Not Found.<br>未找到该资源。")
         except Exception as e:
             logging.error(f"Error processing GET request: {e}")
             self.send_msg_error(500, f"Server got itself in trouble.<br>服务器出错。<br>{e}")
 
+    @timed
     def do_POST(self):
         try:
             if self.path == '/send_message':
-                content_length = int(self.headers['Content-Length'])
+                content_length = int(self.headers.get('Content-Length', 0))
                 post_data = self.rfile.read(content_length).decode('utf-8')
                 post_data = parse_qs(post_data)
                 nickname = post_data.get('nickname', ['匿名'])[0]
@@ -135,18 +1790,16 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
                     return
 
                 # 发送频率上限检查
-                if self.check_message_rate_limit(roomid):
+                retry_after = self.check_message_rate_limit(nickname, roomid)
+                if not retry_after:
                     if message and len(message) <= self.max_message_length:
                         self.add_message(roomid, nickname, message)
                     else:
                         self.send_msg_error(413, f"Request Entity Too Large or is Null.<br>消息过长或为空。", f"<a href='./chat?nickname={nickname}&roomid={roomid}&messageInput={message}'>Back | 返回</a>")
                         return
-                    self.send_response(302)
-                    self.send_header('Location', f'/chat?nickname={quote(nickname)}&roomid={quote(roomid)}&lang={quote(lang)}')
-                    self.end_headers()
-                    self.save_rooms() # 不执行会导致用户无法第一时间读取最新聊天记录
+                    self.send_redirect(302, f'/chat?nickname={quote(nickname)}&roomid={quote(roomid)}&lang={quote(lang)}')
                 else:
-                    self.send_msg_error(429, f"Too Many Requests.<br>请求过于频繁，请稍后重试。", f"<a href='./send_message?nickname={nickname}&roomid={roomid}&messageInput={message}'>Retry | 重试</a><a href='./chat?nickname={nickname}&roomid={roomid}&messageInput={message}'>Back | 返回</a>")
+                    self.send_msg_error(429, f"Too Many Requests.<br>请求过于频繁，请稍后重试。", f"<a href='./send_message?nickname={nickname}&roomid={roomid}&messageInput={message}'>Retry | 重试</a><a href='./chat?nickname={nickname}&roomid={roomid}&messageInput={message}'>Back | 返回</a>", {'Retry-After': str(math.ceil(retry_after))})
             else:
                 self.send_msg_error(404, "Not Found.<br>未找到该资源。")
         except Exception as e:
@@ -154,9 +1807,12 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
             self.send_msg_error(500, f"Server got itself in trouble.<br>服务器出错。<br>{e}")
     
     def get_preferred_language(self):
-        headers = self.headers
-        accept_language = headers.get('Accept-Language')
-    
+        return self.parse_accept_language(self.headers.get('Accept-Language'))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def parse_accept_language(accept_language):
+        # 同一浏览器的 Accept-Language 总是相同，缓存解析结果
         # 检查 accept_language 是否为 None 或空字符串
         if accept_language is None or not accept_language:
             # 如果 Accept-Language 不存在或为空，可以设置一个默认值
@@ -189,61 +1845,110 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
         
         return preferred_language
 
-    def check_message_rate_limit(self, roomid):
-        current_time = time.time()
-        if roomid not in self.message_rate_limit:
-            self.message_rate_limit[roomid] = [current_time]
-            return True
+    def accepts_encoding(self, encoding):
+        accept_encoding = self.headers.get('Accept-Encoding', '')
+        for item in accept_encoding.split(','):
+            parts = item.strip().split(';')
+            if parts[0].strip().lower() == encoding:
+                # q=0 表示明确拒绝该编码
+                return not (len(parts) > 1 and parts[1].strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'))
+        return False
 
-        # Remove old timestamps
-        self.message_rate_limit[roomid] = [t for t in self.message_rate_limit[roomid] if t > current_time - 60]
+    def stream_messages(self, roomid, since):
+        if not self.blocking_requests:
+            self.send_msg_error(503, "Service Unavailable: Live updates are disabled on this server.<br>服务器未启用实时推送。")
+            return
+        subscriber = self.stream_hub.subscribe(roomid)
+        if subscriber is None:
+            self.send_msg_error(503, "Service Unavailable: Too many listeners.<br>实时连接过多，请稍后重试。", headers={'Retry-After': str(self.auto_refresh_interval)})
+            return
+        try:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.end_headers()
+            # 先订阅再读取积压消息，队列中序号重复的事件跳过
+            seq, _, messages = self.store.get_messages(roomid, since)
+            first_seq = seq - len(messages) + 1
+            self.wfile.write(b'retry: 3000\n\n' + b''.join(self.format_event(first_seq + index, message.format()) for index, message in enumerate(messages)))
+            last_seq = seq
+            while True:
+                events = subscriber.pop_events(self.stream_heartbeat_interval)
+                if events is None:
+                    break
+                if not events:
+                    self.wfile.write(b': heartbeat\n\n')
+                    continue
+                data = b''.join(self.format_event(event_seq, line) for event_seq, line in events if event_seq > last_seq)
+                last_seq = max(last_seq, events[-1][0])
+                if data:
+                    self.wfile.write(data)
+        except (ConnectionError, TimeoutError):
+            pass
+        finally:
+            self.stream_hub.unsubscribe(subscriber)
 
-        # 检查是否达到频率上限
-        if len(self.message_rate_limit[roomid]) >= self.max_messages_per_minute:
-            return False
+    def send_export(self, roomid):
+        """以 NDJSON 导出房间的全部归档与内存中的消息，归档分段用 sendfile 直接发送。"""
+        # 先取尚未归档的消息再打开归档：其间写入归档的消息已在分段中，按序号跳过
+        entries = self.store.get_unarchived(roomid)
+        files, archived = self.store.archive.open_segments(roomid) if self.store.archive else ([], 0)
+        with contextlib.ExitStack() as stack:
+            for data_file, _ in files:
+                stack.enter_context(data_file)
+            tail = b''.join(HistoryArchive.encode(seq, message) + b'\n' for seq, message in entries if seq > archived)
+            self.send_response(200)
+            self.send_header('Content-type', 'application/x-ndjson; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Length', str(sum(size for _, size in files) + len(tail)))
+            self.end_headers()
+            for data_file, size in files:
+                self.connection.sendfile(data_file, 0, size)
+            self.wfile.write(tail)
 
-        self.message_rate_limit[roomid].append(current_time)
-        return True
+    @staticmethod
+    def format_event(seq, line):
+        data = ''.join(f'data: {part}\n' for part in line.split('\n'))
+        return f'id: {seq}\n{data}\n'.encode('utf-8')
 
-    def add_message(self, roomid, nickname, message):
-        if roomid not in self.rooms:
-            if len(self.rooms) >= self.max_rooms:
-                oldest_room = next(iter(self.rooms))
-                del self.rooms[oldest_room]
-            self.rooms[roomid] = []
-        messages = self.rooms[roomid]
-        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-        messages.append(f'{timestamp} {nickname}: {message}')
-        if len(messages) > self.max_messages_per_room:
-            messages.pop(0)
-
-    def save_rooms(self):
-        config = ChatConfig().config
-        for roomid, messages in self.rooms.items():
-            config[roomid] = {'messages': '\n'.join(messages)}
-        with open(ChatConfig().config_file, 'w', encoding='utf-8') as configfile:
-            config.write(configfile)
+    def client_ip(self):
+        if self.real_ip_header:
+            forwarded = [address.strip() for value in self.headers.get_all(self.real_ip_header, []) for address in value.split(',') if address.strip()]
+            if forwarded:
+                # 左侧的地址可由客户端伪造，只信任最近 trusted_proxies 层代理追加的地址
+                return forwarded[-min(self.trusted_proxies, len(forwarded))]
+        return self.client_address[0]
 
-    def save_rooms_periodically(self):
-        while True:
-            self.save_rooms()
-            time.sleep(120)
+    def check_message_rate_limit(self, nickname, roomid):
+        """允许发送时返回 0，否则返回需要等待的秒数。"""
+        parts = {'ip': self.client_ip, 'nickname': lambda: nickname, 'room': lambda: roomid}
+        key = tuple(parts[part]() for part in self.rate_limit_by)
+        return self.rate_limiter.check(key)
 
-    def load_rooms(self):
-        config = ChatConfig().config
-        for section in config.sections():
-            self.rooms[section] = config.get(section, 'messages').split('\n')
+    def add_message(self, roomid, nickname, message):
+        self.store.add_message(roomid, nickname, message)
 
-    def generate_css(self):
+    @staticmethod
+    def generate_css():
         return f'''body{{font-family:Arial,sans-serif;background-color:#f4f4f4;margin:0;padding-top:20px;color:#333}}.hide{{display:none}}.container{{box-sizing:border-box;overflow:hidden;width:100%;max-width:600px;margin:0 auto;padding:20px;background-color:#fff;border:1px solid #ccc;box-shadow:2px 2px 5px rgba(0,0,0,0.1);border-radius:5px}}fieldset{{border:1px solid #ddd;padding:10px;margin-bottom:5px}}legend{{font-weight:bold;padding:0 10px}}label{{display:block;margin-bottom:5px}}input[type="text"],iframe,.content{{box-sizing:border-box;max-width:100%;width:100%;padding:8px;margin-bottom:10px;border:1px solid #ddd;border-radius:3px}}a,a:visited,button{{align-items:center;text-decoration:none;padding:8px 15px;margin-right:5px;background-color:#007BFF;color:#fff;border:none;border-radius:3px;cursor:pointer}}a:hover,a:visited:hover,button:hover{{background-color:#0056b3}}button:active{{background-color:#0067b8}}@media (max-width:600px){{.container{{width:100%;height:100%;border:none;border-radius:0;box-shadow:none}}}}.loading-bar{{position:fixed;top:0;left:0;z-index:99999;opacity:0;transition:opacity .4s linear;.progress{{position:fixed;top:0;left:0;width:0;height:4px;background-color:#007bff;box-shadow:0 0 10px rgba(119,182,255,.7)}}&.loading{{opacity:1;transition:none;.progress{{transition:width .4s ease}}}}}}'''.encode('utf-8')
 
-    def generate_js(self):
+    @staticmethod
+    def generate_js():
         return f'''(function(){{var loadingBar=document.querySelector(".loading-bar");var progress=document.querySelector(".loading-bar .progress");var timer=null;let pjax;function initAni(){{loadingBar=document.querySelector(".loading-bar");progress=document.querySelector(".loading-bar .progress")}}function initPjax(){{try{{const Pjax=window.Pjax||function(){{}};pjax=new Pjax({{selectors:["head meta","head title","body .container",".pjax-reload"],cacheBust:false}})}}catch(e){{console.log('PJAX 初始化出错：'+e)}}}}function endLoad(){{clearInterval(timer);progress.style.width="100%";loadingBar.classList.remove("loading");setTimeout(function(){{progress.style.width=0}},400)}}function initialize(){{initPjax();initAni()}}window.addEventListener('DOMContentLoaded',()=>initialize());document.addEventListener("pjax:send",function(){{var loadingBarWidth=20;var MAX_LOADING_WIDTH=95;loadingBar.classList.add("loading");progress.style.width=loadingBarWidth+"%";clearInterval(timer);timer=setInterval(function(){{loadingBarWidth+=3;if(loadingBarWidth>MAX_LOADING_WIDTH){{loadingBarWidth=MAX_LOADING_WIDTH}}progress.style.width=loadingBarWidth+"%"}},500)}});document.addEventListener("pjax:complete",function(){{endLoad()}})}})();'''.encode('utf-8')
 
-    def generate_favicon(self):
+    @staticmethod
+    def generate_log_js():
+        return '''(function(){var log=document.getElementById("log");function refresh(){setTimeout(function(){location.reload()},log.getAttribute("data-refresh")*1000)}if(!window.EventSource){refresh();return}var source=new EventSource("./stream?id="+encodeURIComponent(log.getAttribute("data-room"))+"&since="+log.getAttribute("data-seq"));source.onerror=function(){if(source.readyState===2){refresh()}};source.onmessage=function(e){var empty=log.getElementsByTagName("p")[0];if(empty){log.removeChild(empty)}if(log.childNodes.length){log.appendChild(document.createElement("br"))}log.appendChild(document.createTextNode(e.data));window.scrollTo(0,document.documentElement.scrollHeight)}})();'''.encode('utf-8')
+
+    @staticmethod
+    def generate_favicon():
         return '''<svg xmlns="http://www.w3.org/2000/svg" width="50" height="50"><circle cx="25" cy="25" r="20" fill="blue" /></svg>'''.encode('utf-8')
 
-    def generate_home_html(self, nickname, roomid, lang='zh'):
+    @classmethod
+    def home_template(cls, lang):
         if lang != 'zh':
             head_lang = 'en-US'
             title = 'LB-Chat'
@@ -266,9 +1971,10 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
             source_code_url = 'https://gitee.com/PJ-568/lb-chat'
             switch_lang = 'English'
             to_lang = 'en'
-        return f'''<!DOCTYPE html><html lang="{head_lang}"><head><meta charset="UTF-8"><title>{title}</title><link type="text/css" rel="stylesheet" href="lb-chat.css"><meta name="viewport" content="width=192, initial-scale=1.0"><script src="//lib.baomitu.com/pjax/0.2.8/pjax.min.js" type="text/javascript"></script><script src="main.js" type="text/javascript"></script></head><body><div class="container"><form action="./chat" method="get"><fieldset><legend>{legend}</legend><label for="nickname">{show_nickname}</label><input type="text" id="nickname" name="nickname" value="{nickname}" placeholder="匿名"><br><label for="roomid">{show_roomid}</label><input type="text" id="roomid" name="roomid" value="{roomid}" placeholder="默认"><br><button type="submit">{enter_room}</button><a href="{source_code_url}" target="_blank">{source_code}</a><a href="?nickname={quote(nickname)}&roomid={quote(roomid)}&lang={to_lang}">{switch_lang}</a></fieldset><input type="text" id="lang" name="lang" value="{lang}" class="hide"></form></div><div class="loading-bar"><div class="progress"></div></div></body></html>'''.encode('utf-8')
+        return f'''<!DOCTYPE html><html lang="{head_lang}"><head><meta charset="UTF-8"><title>{title}</title><link type="text/css" rel="stylesheet" href="lb-chat.css"><meta name="viewport" content="width=192, initial-scale=1.0"><script src="//lib.baomitu.com/pjax/0.2.8/pjax.min.js" type="text/javascript"></script><script src="main.js" type="text/javascript"></script></head><body><div class="container"><form action="./chat" method="get"><fieldset><legend>{legend}</legend><label for="nickname">{show_nickname}</label><input type="text" id="nickname" name="nickname" value="{{nickname}}" placeholder="匿名"><br><label for="roomid">{show_roomid}</label><input type="text" id="roomid" name="roomid" value="{{roomid}}" placeholder="默认"><br><button type="submit">{enter_room}</button><a href="{source_code_url}" target="_blank">{source_code}</a><a href="?nickname={{nickname_url}}&roomid={{roomid_url}}&lang={to_lang}">{switch_lang}</a></fieldset><input type="text" id="lang" name="lang" value="{{lang}}" class="hide"></form></div><div class="loading-bar"><div class="progress"></div></div></body></html>'''
 
-    def generate_chat_html(self, nickname, roomid, message, lang='zh'):
+    @classmethod
+    def chat_template(cls, lang):
         if lang != 'zh':
             head_lang = 'en-US'
             title = 'LB-Chat'
@@ -283,30 +1989,119 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
             says = '说：'
             send = '发送'
             back = '返回'
-        return f'''<!DOCTYPE html><html lang="{head_lang}"><head><meta charset="UTF-8"><title>{title} - {roomid}</title><link type="text/css" rel="stylesheet" href="lb-chat.css"><meta name="viewport" content="width=192, initial-scale=1.0"><script src="//lib.baomitu.com/pjax/0.2.8/pjax.min.js" type="text/javascript"></script><script src="main.js" type="text/javascript"></script></head><body><div class="container"><form action="./send_message" method="post"><fieldset><legend>{title} - {roomid}</legend><iframe title="{chat_log}" src="./log?id={roomid}&lang={lang}" frameborder="0"></iframe><br><label for="messageInput">{nickname}{says}</label><input type="text" id="messageInput" name="messageInput" value="{message}"><button type="submit">{send}</button><a href=".?nickname={quote(nickname)}&roomid={quote(roomid)}&lang={quote(lang)}">{back}</a></fieldset><input type="text" id="nickname" name="nickname" value="{nickname}" class="hide"><input type="text" id="roomid" name="roomid" value="{roomid}" class="hide"><input type="text" id="lang" name="lang" value="{lang}" class="hide"></form></div><div class="loading-bar"><div class="progress"></div></div></body></html>'''.encode('utf-8')
+        return f'''<!DOCTYPE html><html lang="{head_lang}"><head><meta charset="UTF-8"><title>{title} - {{roomid}}</title><link type="text/css" rel="stylesheet" href="lb-chat.css"><meta name="viewport" content="width=192, initial-scale=1.0"><script src="//lib.baomitu.com/pjax/0.2.8/pjax.min.js" type="text/javascript"></script><script src="main.js" type="text/javascript"></script></head><body><div class="container"><form action="./send_message" method="post"><fieldset><legend>{title} - {{roomid}}</legend><iframe title="{chat_log}" src="./log?id={{roomid_url}}&lang={{lang_url}}" frameborder="0"></iframe><br><label for="messageInput">{{nickname}}{says}</label><input type="text" id="messageInput" name="messageInput" value="{{message}}"><button type="submit">{send}</button><a href=".?nickname={{nickname_url}}&roomid={{roomid_url}}&lang={{lang_url}}">{back}</a></fieldset><input type="text" id="nickname" name="nickname" value="{{nickname}}" class="hide"><input type="text" id="roomid" name="roomid" value="{{roomid}}" class="hide"><input type="text" id="lang" name="lang" value="{{lang}}" class="hide"></form></div><div class="loading-bar"><div class="progress"></div></div></body></html>'''
 
-    def generate_chat_log_html(self, roomid, lang = 'zh'):
+    @classmethod
+    def chat_log_template(cls, lang):
         if lang != 'zh':
             title = 'Chat Log'
-            empty_msg = 'No messages yet'
         else:
             title = '聊天记录'
+        # 支持 EventSource 的浏览器由 log.js 实时推送新消息，不支持 JS 的浏览器按 noscript 中的 refresh 定时刷新
+        return f'''<!DOCTYPE html><html lang="zh-Hans"><head><meta charset="UTF-8"><title>{title}-{{roomid}}</title><meta name="viewport"content="width=device-width, initial-scale=1.0"><noscript><meta http-equiv="refresh"content="{cls.auto_refresh_interval}"></noscript><script>document.addEventListener('DOMContentLoaded',function(){{{{window.scrollTo(0,document.documentElement.scrollHeight)}}}});</script></head><body style="font-family: Arial, sans-serif;"><span id="log" data-room="{{roomid}}" data-seq="{{seq}}" data-refresh="{cls.auto_refresh_interval}">{{chat_log}}</span><script src="log.js" type="text/javascript"></script></body></html>'''
+
+    @classmethod
+    def prepare(cls):
+        """启动时为每种语言预编译页面模板，并构建静态资源及其压缩版本。"""
+        cls.templates = {}
+        for lang in ('zh', 'en'):
+            cls.templates['home', lang] = PageTemplate(cls.home_template(lang))
+            cls.templates['chat', lang] = PageTemplate(cls.chat_template(lang))
+            cls.templates['log', lang] = PageTemplate(cls.chat_log_template(lang))
+        cls.assets = {
+            '/lb-chat.css': StaticAsset(cls.generate_css(), 'text/css'),
+            '/main.js': StaticAsset(cls.generate_js(), 'text/javascript'),
+            '/log.js': StaticAsset(cls.generate_log_js(), 'text/javascript'),
+            '/favicon.ico': StaticAsset(cls.generate_favicon(), 'image/svg+xml'),
+        }
+
+    def generate_home_html(self, nickname, roomid, lang='zh'):
+        template = self.templates['home', 'zh' if lang == 'zh' else 'en']
+        return template.render(nickname=html.escape(nickname), roomid=html.escape(roomid), lang=html.escape(lang), nickname_url=quote(nickname), roomid_url=quote(roomid))
+
+    def generate_chat_html(self, nickname, roomid, message, lang='zh'):
+        template = self.templates['chat', 'zh' if lang == 'zh' else 'en']
+        return template.render(nickname=html.escape(nickname), roomid=html.escape(roomid), message=html.escape(message), lang=html.escape(lang), nickname_url=quote(nickname), roomid_url=quote(roomid), lang_url=quote(lang))
+
+    def generate_chat_log_html(self, roomid, messages, seq, lang = 'zh', since = 0):
+        if lang != 'zh':
+            empty_msg = 'No messages yet'
+        else:
             empty_msg = '无聊天记录'
-        messages = self.rooms.get(roomid, [])
-        chat_log = '<br>'.join(messages) if messages else f'<p style="color:#ccc">{empty_msg}</p>'
-        return f'''<!DOCTYPE html><html lang="zh-Hans"><head><meta charset="UTF-8"><title>{title}-{roomid}</title><meta name="viewport"content="width=device-width, initial-scale=1.0"><meta http-equiv="refresh"content="{{self.auto_refresh_interval}}"><script>document.addEventListener('DOMContentLoaded',function(){{window.scrollTo(0,document.documentElement.scrollHeight)}});</script></head><body style="font-family: Arial, sans-serif;"><span>{chat_log}</span></body></html>'''.encode('utf-8')
+        # 增量请求没有新消息时返回空列表，而不是“无聊天记录”
+        if messages or since > 0:
+            chat_log = '<br>'.join(html.escape(message.format()) for message in messages)
+        else:
+            chat_log = f'<p style="color:#ccc">{empty_msg}</p>'
+        return self.templates['log', 'zh' if lang == 'zh' else 'en'].render(roomid=html.escape(roomid), seq=str(seq), chat_log=chat_log)
 
     def generate_error_html(self, errorCode, errorMsg = '', buttons = "<a href='/'>返回主页 | Back</a>"):
         if not errorMsg:
             errorMsg = f'错误代码：{errorCode}<br>Error code: {errorCode}'
         return f'''<!DOCTYPE html><html lang="zh-Hans"><head><meta charset="UTF-8"><title>错误：{errorCode}</title><link type="text/css" rel="stylesheet" href="/lb-chat.css"><meta name="viewport" content="width=192, initial-scale=1.0"><script src="//lib.baomitu.com/pjax/0.2.8/pjax.min.js" type="text/javascript"></script><script src="/main.js" type="text/javascript"></script></head><body><div class="container"><fieldset><legend>错误：{errorCode}</legend><div class="content">{errorMsg}</div>{buttons}</fieldset></div><div class="loading-bar"><div class="progress"></div></div></body></html>'''.encode('utf-8')
 
-    def send_msg_error(self, errorCode, errorMsg = '', buttons = "<a href='/'>返回主页 | Back</a>"):
-        self.send_response(errorCode)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.send_header('Cache-Control', 'public, max-age=15')
+    def send_content(self, body, content_type, cache_control, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Cache-Control', cache_control)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        # 持久连接依赖 Content-Length 判断响应结束
+        self.send_header('Content-Length', str(len(body)))
+        if self.request_version == 'HTTP/0.9':
+            # HTTP/0.9 的响应没有状态行与头部，只有正文
+            self.wfile.write(body)
+            return
+        # 状态行、头部与正文合并为一次写入
+        self._headers_buffer.append(b'\r\n')
+        self._headers_buffer.append(body)
+        self.flush_headers()
+
+    def send_asset(self, asset, headers=None):
+        headers = dict(headers or {}, ETag=asset.etag)
+        cache_control = f'public, max-age={self.max_cache_time}'
+        if asset.variants:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.is_not_modified(asset.etag, None):
+            self.send_not_modified(cache_control, headers)
+            return
+        body = asset.body
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and self.accepts_encoding(encoding):
+                headers['Content-Encoding'] = encoding
+                body = asset.variants[encoding]
+                break
+        self.send_content(body, asset.content_type, cache_control, headers=headers)
+
+    def is_not_modified(self, etag, modified):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # 弱比较：忽略 W/ 前缀，gzip 与未压缩版本共用同一个 ETag
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag.removeprefix('W/') in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and modified is not None:
+            try:
+                return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_not_modified(self, cache_control, headers):
+        self.send_response(304)
+        self.send_header('Cache-Control', cache_control)
+        for key, value in headers.items():
+            self.send_header(key, value)
         self.end_headers()
-        self.wfile.write(self.generate_error_html(errorCode, errorMsg, buttons))
+
+    def send_redirect(self, status, location):
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_msg_error(self, errorCode, errorMsg = '', buttons = "<a href='/'>返回主页 | Back</a>", headers=None):
+        self.send_content(self.generate_error_html(errorCode, errorMsg, buttons), 'text/html; charset=utf-8', 'public, max-age=15', errorCode, headers)
 
     # def send_file(self, filename):
     #     try:
@@ -325,17 +2120,250 @@ class ChatServer(http.server.BaseHTTPRequestHandler):
     #         self.send_msg_error(404, "Not Found.<br>未找到该资源。")
 
 
+class ThreadPoolHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """使用固定大小线程池处理连接的 HTTP 服务器。"""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, workers=16, bind_and_activate=True):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-worker')
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+class ThreadPerConnectionHTTPServer(http.server.ThreadingHTTPServer):
+    """每个连接一个线程，适合大量空闲的持久连接。"""
+    request_queue_size = 128
+
+
+def handle_sigterm(signum, frame):
+    # 让 serve_forever 退出，进入 finally 中的关闭保存
+    sys.exit(0)
+
+
+def create_server(server_address, engine='thread', workers=16, reuse_port=False):
+    if engine == 'thread':
+        httpd = ThreadPerConnectionHTTPServer(server_address, ChatServer, bind_and_activate=False)
+    else:
+        # 线程池与单线程模式的处理线程有限：关闭持久连接，不挂起长轮询与实时推送，
+        # 以免空闲或等待中的连接占满线程而阻塞其他客户端
+        ChatServer.protocol_version = 'HTTP/1.0'
+        ChatServer.blocking_requests = False
+        if engine == 'pool':
+            httpd = ThreadPoolHTTPServer(server_address, ChatServer, workers, bind_and_activate=False)
+        else:
+            httpd = http.server.HTTPServer(server_address, ChatServer, bind_and_activate=False)
+    try:
+        if reuse_port:
+            # 多个工作进程各自监听同一端口，由内核分配连接
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        httpd.server_bind()
+        httpd.server_activate()
+    except BaseException:
+        httpd.server_close()
+        raise
+    return httpd
+
+
+def create_store(args):
+    if args.storage == 'sqlite':
+        store = SqliteChatStore(args.db_file, args.sync_interval, args.data_file)
+    elif args.storage == 'journal':
+        store = JournalChatStore(args.journal_file, args.flush_interval, args.data_file)
+    else:
+        store = ChatStore(args.data_file, args.flush_interval)
+    if args.archive_dir:
+        store.archive = HistoryArchive(args.archive_dir, args.archive_retention_days * 86400, args.archive_max_size * 1024 * 1024)
+        # SQLite 的工作进程在后台竞争归档目录锁，其他存储只有一个进程
+        if args.storage != 'sqlite' and not store.archive.acquire():
+            raise RuntimeError(f"Archive directory {args.archive_dir} is in use by another process")
+    return store
+
+
+def serve(args, reuse_port=False):
+    store = create_store(args)
+    store.load()
+    log_cache = LogCache(args.log_cache_size * 1024)
+    store.listeners.append(log_cache.invalidate)
+    stream_hub = StreamHub(store, args.max_stream_subscribers, args.stream_queue_size)
+    store.listeners.append(stream_hub.publish)
+    if args.processes > 1:
+        # 限流状态放在共享数据库中，各工作进程看到相同的计数
+        ChatServer.rate_limiter = SqliteRateLimiter(ChatServer.rate_limiter, store.database)
+    store.start()
+    ChatServer.store = store
+    ChatServer.log_cache = log_cache
+    ChatServer.stream_hub = stream_hub
+    ChatServer.stream_heartbeat_interval = args.stream_heartbeat_interval
+    metrics = None
+    if args.metrics:
+        # 多进程时经共享数据库汇总各工作进程的指标
+        metrics = Metrics(store, log_cache, ChatServer.rate_limiter, stream_hub, store.database if args.processes > 1 else None)
+        metrics.start()
+    ChatServer.metrics = metrics
+    ChatServer.access_log_sample = args.access_log_sample
+    access_log_listener = start_access_log()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    server_address = ('0.0.0.0', args.port)
+    httpd = create_server(server_address, args.engine, args.workers, reuse_port)
+
+    if not reuse_port:
+        print(f'Starting server at http://127.0.0.1:{args.port} ({args.engine}) ...')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream_hub.close()
+        httpd.server_close()
+        if metrics is not None:
+            metrics.close()
+        store.close()
+        logging.info(f"Chat log cache: {log_cache.stats()}")
+        access_log_listener.stop()
+
+
+def run_workers(args):
+    """预先 fork 多个工作进程，共享监听端口与 SQLite 中的聊天室状态。"""
+    # 父进程只初始化数据库，不启动任何线程，避免 fork 后子进程继承锁状态
+    store = create_store(args)
+    store.load()
+    store.close()
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                serve(args, reuse_port=True)
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException:
+                logging.exception("Worker process failed")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(args.processes):
+        spawn()
+    print(f'Starting server at http://127.0.0.1:{args.port} ({args.processes} processes, {args.engine}) ...')
+    while children:
+        pid, status = os.wait()
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < 5:
+            # 刚启动就退出（例如端口被占用），重启也无济于事
+            logging.error(f"Worker {pid} exited during startup, shutting down")
+            stop(signal.SIGTERM, None)
+        else:
+            logging.warning(f"Worker {pid} exited unexpectedly, restarting")
+            spawn()
+
+
 def main():
     parser = argparse.ArgumentParser(description='聊天室')
     parser.add_argument('--port', type=int, default=2666, help='Port to listen on.')
+    parser.add_argument('--engine', choices=['thread', 'pool', 'single'], default='thread', help='Serving engine: thread per connection, fixed thread pool, or single-threaded. Only thread supports keep-alive, long-polling and /stream.')
+    parser.add_argument('--workers', type=int, default=16, help='Worker threads for the pool engine.')
+    parser.add_argument('--keep-alive-timeout', type=int, default=ChatServer.keep_alive_timeout, help='Seconds before an idle keep-alive connection is closed.')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes sharing the port via SO_REUSEPORT; requires --storage sqlite.')
+    parser.add_argument('--storage', choices=['journal', 'ini', 'sqlite'], default='journal', help='Persistence backend: append-only journal with snapshots, INI file only, or SQLite shared by worker processes.')
+    parser.add_argument('--data-file', default='chat_records.ini', help='INI file to save chat records to, or to import from on first journal start.')
+    parser.add_argument('--journal-file', default='chat_records.journal', help='Journal file for the journal backend.')
+    parser.add_argument('--db-file', default='chat_records.db', help='Database file for the sqlite backend.')
+    parser.add_argument('--sync-interval', type=float, default=0.5, help='Seconds between checks for changes made by other worker processes (sqlite backend).')
+    parser.add_argument('--flush-interval', type=int, default=120, help='Seconds between periodic saves (INI) or compactions (journal).')
+    parser.add_argument('--log-cache-size', type=int, default=8192, help='Memory limit in KiB for cached rendered chat logs.')
+    parser.add_argument('--max-rooms', type=int, default=ChatStore.max_rooms, help='Maximum number of rooms; the least recently active room is evicted.')
+    parser.add_argument('--max-messages-per-room', type=int, default=ChatStore.max_messages_per_room, help='Messages kept in memory per room.')
+    parser.add_argument('--max-message-length', type=int, default=ChatServer.max_message_length, help='Maximum characters per message.')
+    parser.add_argument('--max-messages-per-minute', type=int, default=ChatServer.max_messages_per_minute, help='Rate limit for sending messages.')
+    parser.add_argument('--rate-limiter', choices=['token-bucket', 'sliding-window'], default='token-bucket', help='Rate limiting algorithm for sending messages.')
+    parser.add_argument('--rate-limit-by', default=','.join(ChatServer.rate_limit_by), help='Comma-separated rate limit key parts: ip, nickname, room.')
+    parser.add_argument('--real-ip-header', help='Header holding the client IP when behind a reverse proxy, e.g. X-Forwarded-For.')
+    parser.add_argument('--trusted-proxies', type=int, default=ChatServer.trusted_proxies, help='Number of trusted reverse proxies appending to --real-ip-header; the client IP is taken that many entries from the right.')
+    parser.add_argument('--max-cache-time', type=int, default=ChatServer.max_cache_time, help='Cache-Control max-age in seconds for pages and assets.')
+    parser.add_argument('--auto-refresh-interval', type=int, default=ChatServer.auto_refresh_interval, help='Seconds between automatic refreshes of the chat log page.')
+    parser.add_argument('--max-long-poll-time', type=float, default=ChatServer.max_long_poll_time, help='Maximum seconds a /log long-poll request may wait.')
+    parser.add_argument('--max-stream-subscribers', type=int, default=1000, help='Maximum concurrent /stream connections.')
+    parser.add_argument('--stream-queue-size', type=int, default=100, help='Undelivered events per /stream connection before it is dropped as too slow.')
+    parser.add_argument('--stream-heartbeat-interval', type=float, default=ChatServer.stream_heartbeat_interval, help='Seconds between /stream heartbeats.')
+    parser.add_argument('--archive-dir', help='Directory for archiving messages that fall out of memory, served by /history and /export (default: disabled).')
+    parser.add_argument('--archive-retention-days', type=float, default=0, help='Delete archived messages older than this many days (0: keep forever).')
+    parser.add_argument('--archive-max-size', type=int, default=1024, help='Maximum archive size in MiB; the oldest segments are deleted first (0: unlimited).')
+    parser.add_argument('--metrics', action='store_true', help='Record request timings and serve them at /metrics in Prometheus text format.')
+    parser.add_argument('--access-log-sample', type=float, default=1.0, help='Fraction of requests written to the access log (0 disables it).')
+    parser.add_argument('--import-ini', metavar='FILE', help='Import chat records from an INI file before starting.')
+    parser.add_argument('--export-ini', metavar='FILE', help='Export chat records to an INI file and exit.')
     args = parser.parse_args()
 
-    server_address = ('0.0.0.0', args.port)
-    httpd = socketserver.TCPServer(server_address, ChatServer)
-    httpd.allow_reuse_address = True
+    if args.processes > 1:
+        if args.storage != 'sqlite':
+            parser.error('--processes requires --storage sqlite')
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--processes is not supported on this platform')
+
+    ChatServer.keep_alive_timeout = ChatServer.timeout = args.keep_alive_timeout
+    ChatServer.max_message_length = args.max_message_length
+    ChatServer.max_messages_per_minute = args.max_messages_per_minute
+    if args.max_messages_per_minute < 1:
+        parser.error('--max-messages-per-minute must be at least 1')
+    rate_limit_by = tuple(part.strip() for part in args.rate_limit_by.split(',') if part.strip())
+    if not rate_limit_by or not set(rate_limit_by) <= {'ip', 'nickname', 'room'}:
+        parser.error('--rate-limit-by must list ip, nickname and/or room')
+    ChatServer.rate_limit_by = rate_limit_by
+    ChatServer.real_ip_header = args.real_ip_header
+    if args.trusted_proxies < 1:
+        parser.error('--trusted-proxies must be at least 1')
+    ChatServer.trusted_proxies = args.trusted_proxies
+    if args.rate_limiter == 'sliding-window':
+        ChatServer.rate_limiter = SlidingWindowLimiter(args.max_messages_per_minute)
+    else:
+        ChatServer.rate_limiter = TokenBucketLimiter(args.max_messages_per_minute)
+    ChatServer.max_cache_time = args.max_cache_time
+    ChatServer.auto_refresh_interval = args.auto_refresh_interval
+    ChatServer.max_long_poll_time = args.max_long_poll_time
+    ChatServer.prepare()
+    ChatStore.max_rooms = args.max_rooms
+    ChatStore.max_messages_per_room = args.max_messages_per_room
+
+    if args.import_ini or args.export_ini:
+        store = create_store(args)
+        store.load()
+        if args.import_ini:
+            store.import_ini(args.import_ini)
+            store.save()
+        if args.export_ini:
+            store.export_ini(args.export_ini)
+            store.close()
+            return
+        store.close()
 
-    print(f'Starting server at http://127.0.0.1:{args.port} ...')
-    httpd.serve_forever()
+    if args.processes > 1:
+        run_workers(args)
+    else:
+        serve(args)
 
 if __name__ == '__main__':
     main()